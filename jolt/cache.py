@@ -11,9 +11,11 @@ import uuid
 
 from jolt import config
 from jolt import filesystem as fs
+from jolt import hooks
 from jolt import influence
 from jolt import log
 from jolt import tools
+from jolt import trace
 from jolt import utils
 from jolt.options import JoltOptions
 from jolt.error import raise_error, raise_error_if
@@ -960,6 +962,9 @@ class ArtifactCache(StorageProvider):
         self._lock_file = fasteners.InterProcessLock(self._fs_get_lock_file())
         self._thread_lock = RLock()
 
+        # Artifact uploads still in progress in background threads
+        self._pending_uploads = {}
+
         # Create process lock file
         with self._cache_lock():
             self._pid = pidprovider() if pidprovider else PidProvider()()
@@ -981,11 +986,20 @@ class ArtifactCache(StorageProvider):
             log.verbose("Cache size is {} (max {}, {} artifacts, {} in use)",
                         cur_size, max_size, count, in_use)
         atexit.register(self.close)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_locks)
 
     ############################################################################
     # Internal API
     ############################################################################
 
+    def _reset_locks(self):
+        # Called in forked child processes. Locks held by other
+        # threads in the parent process are not held in the child.
+        self._cache_locked = False
+        self._lock_file = fasteners.InterProcessLock(self._fs_get_lock_file())
+        self._thread_lock = RLock()
+
     def _assert_cache_locked(self):
         assert self._cache_locked, "illegal function call, cache lock is not held"
 
@@ -1209,7 +1223,8 @@ class ArtifactCache(StorageProvider):
             "Can't compress an unpublished task artifact")
 
         try:
-            task.tools.archive(artifact.path, archive)
+            with trace.span("compress", task=task):
+                task.tools.archive(artifact.path, archive)
         except KeyboardInterrupt as e:
             raise e
         except Exception:
@@ -1223,7 +1238,8 @@ class ArtifactCache(StorageProvider):
         task = artifact.get_task()
         archive = artifact.get_archive_path()
         try:
-            task.tools.extract(archive, artifact.temporary_path, ignore_owner=True)
+            with trace.span("decompress", task=task):
+                task.tools.extract(archive, artifact.temporary_path, ignore_owner=True)
         except KeyboardInterrupt as e:
             raise e
         except Exception:
@@ -1330,6 +1346,11 @@ class ArtifactCache(StorageProvider):
     # Public API
     ############################################################################
 
+    def get_identities(self):
+        """ Returns the identities of all artifacts in the local cache. """
+        with self._cache_lock(), self._db() as db:
+            return [row[0] for row in self._db_select_artifacts(db)]
+
     def is_available_locally(self, node):
         """
         Check presence of task artifact in cache.
@@ -1404,14 +1425,16 @@ class ArtifactCache(StorageProvider):
             return False
         if not node.is_downloadable():
             return True
-        with self.get_locked_artifact(node) as artifact:
+        with self.get_locked_artifact(node) as artifact, trace.span("download", task=node):
             if self.is_available_locally(node):
                 node.info("Download skipped, already in local cache")
                 return True
+            duration = utils.duration()
             for provider in self._storage_providers:
                 if provider.download(node, force):
                     self._fs_decompress_artifact(artifact)
                     self.commit(artifact)
+                    hooks.task_downloaded(node, duration.seconds)
                     return True
         return len(self._storage_providers) == 0
 
@@ -1428,15 +1451,52 @@ class ArtifactCache(StorageProvider):
         raise_task_error_if(
             not self.is_available_locally(node), node,
             "Can't upload task artifact, no artifact present in the local cache")
-        with self.get_locked_artifact(node) if locked else self.get_artifact(node) as artifact:
+        with self.get_locked_artifact(node) if locked else self.get_artifact(node) as artifact, \
+             trace.span("upload", task=node):
             raise_task_error_if(
                 not artifact.is_uploadable(), node,
                 "Artifact was modified locally by another process and can no longer be uploaded, try again")
             if self._storage_providers:
+                duration = utils.duration()
                 with self._fs_compress_artifact(artifact):
-                    return all([provider.upload(node, force) for provider in self._storage_providers])
+                    uploaded = all([provider.upload(node, force) for provider in self._storage_providers])
+                if uploaded:
+                    hooks.task_uploaded(node, duration.seconds)
+                return uploaded
         return len(self._storage_providers) == 0
 
+    def upload_async(self, node, executor, lock, force=False):
+        """
+        Uploads an artifact from the local cache in the background.
+
+        The caller must hold the artifact lock. Ownership of the lock,
+        an ExitStack, is transferred to the upload which releases it
+        once the transfer has finished. Unpacking of the artifact in
+        this process is deferred until then.
+
+        Returns a future with the result of :meth:`upload`.
+        """
+        def _upload():
+            try:
+                with lock:
+                    return self.upload(node, force=force, locked=False)
+            finally:
+                with self._thread_lock:
+                    if self._pending_uploads.get(node.identity) is future:
+                        del self._pending_uploads[node.identity]
+
+        with self._thread_lock:
+            future = executor.submit(_upload)
+            self._pending_uploads[node.identity] = future
+        return future
+
+    def _wait_for_upload(self, node):
+        with self._thread_lock:
+            future = self._pending_uploads.get(node.identity)
+        if future is not None and not future.done():
+            node.verbose("Waiting for artifact upload to complete")
+            utils.call_and_catch(future.result)
+
     def location(self, node):
         if not node.task.is_cacheable():
             return ''
@@ -1462,6 +1522,7 @@ class ArtifactCache(StorageProvider):
             return False
         if not node.is_unpackable():
             return True
+        self._wait_for_upload(node)
         with self._thread_lock, self.get_locked_artifact(node) as artifact:
             if not self.is_available_locally(node):
                 raise_task_error(node, "Locked artifact is missing in cache (forcibly removed?)")
@@ -1474,7 +1535,7 @@ class ArtifactCache(StorageProvider):
             fs.copy(artifact.path, artifact.temporary_path, symlinks=True)
 
             task = artifact.get_task()
-            with tools.Tools(task) as t:
+            with tools.Tools(task) as t, trace.span("unpack", task=node):
                 try:
                     # Note: unpack() will run on the original
                     # artifact, not in the temporary copy.
@@ -1615,7 +1676,8 @@ class ArtifactCache(StorageProvider):
             is_locked = lock.acquire(blocking=False)
         if not is_locked:
             node.info("Artifact is temporarily locked by another process")
-            lock.acquire()
+            with trace.span("lock wait", task=node):
+                lock.acquire()
 
         try:
             artifact = self.get_artifact(node)
@@ -1,5 +1,6 @@
 import atexit
 import click
+import json
 import subprocess
 import sys
 import uuid
@@ -18,6 +19,7 @@ from jolt.log import logfile
 from jolt import config
 from jolt.loader import JoltLoader
 from jolt import tools
+from jolt import trace
 from jolt import utils
 from jolt.influence import HashInfluenceRegistry
 from jolt.options import JoltOptions
@@ -130,6 +132,10 @@ def cli(ctx, verbose, extra_verbose, config_file, debugger, profile,
         # plugins that are not yet configured.
         return
 
+    if ctx.invoked_subcommand in ["amqp-resident"]:
+        # Resident workers load recipes in forked processes, per build.
+        return
+
     if ctx.invoked_subcommand is None:
         build = ctx.command.get_command(ctx, "build")
 
@@ -211,11 +217,16 @@ def _autocomplete_tasks(ctx, args, incomplete):
               help="Don't prune cached artifacts from the build graph. This option can be used to populate the local cache with remotely cached dependency artifacts.")
 @click.option("--worker", is_flag=True, default=False,
               help="Run with the worker build strategy", hidden=True)
+@click.option("--explain-schedule", is_flag=True, default=False,
+              help="Compare the predicted and actual schedule once the build has finished.")
+@click.option("--trace", "trace_file", type=click.Path(), default=None,
+              help="Write a Chrome trace of the build execution to TRACE. The trace can be loaded into Perfetto.",
+              metavar="TRACE")
 @click.pass_context
 @hooks.cli_build
 def build(ctx, task, network, keep_going, default, local,
           no_download, no_upload, download, upload, worker, force,
-          salt, copy, debug, result, jobs, no_prune):
+          salt, copy, debug, result, jobs, no_prune, explain_schedule, trace_file):
     """
     Build task artifact.
 
@@ -298,10 +309,12 @@ def build(ctx, task, network, keep_going, default, local,
     acache = cache.ArtifactCache.get(options)
 
     executors = scheduler.ExecutorRegistry.get(options)
+    manifest = ctx.obj["manifest"]
     if worker:
         log.set_worker()
         log.verbose("Local build as a worker")
-        strategy = scheduler.WorkerStrategy(executors, acache)
+        batch = manifest.get_parameter("jolt_batch")
+        strategy = scheduler.WorkerStrategy(executors, acache, batch=json.loads(batch) if batch else None)
     elif network:
         log.verbose("Distributed build as a user")
         strategy = scheduler.DistributedStrategy(executors, acache)
@@ -315,7 +328,8 @@ def build(ctx, task, network, keep_going, default, local,
     for params in default:
         registry.set_default_parameters(params)
 
-    manifest = ctx.obj["manifest"]
+    if trace_file or (worker and manifest.get_parameter("jolt_trace")):
+        trace.enable()
 
     for mb in manifest.builds:
         for mt in mb.tasks:
@@ -338,11 +352,16 @@ def build(ctx, task, network, keep_going, default, local,
     goal_task_duration = 0
 
     queue = scheduler.TaskQueue(strategy)
+    critical_path = None
 
     try:
         if not dag.has_tasks():
             return
 
+        critical_path = scheduler.CriticalPath(
+            dag, acache, network=network and not worker,
+            parallelism=executors.get_parallelism(network and not worker))
+
         progress = log.progress(
             "Progress",
             dag.number_of_tasks(filterfn=lambda t: not t.is_resource()),
@@ -370,6 +389,9 @@ def build(ctx, task, network, keep_going, default, local,
                 elif task.is_goal() and task.duration_running:
                     goal_task_duration += task.duration_running.seconds
 
+                if error is None:
+                    critical_path.task_finished(task)
+
                 if not task.is_resource():
                     if no_prune and task.task.unpack.__func__ is not Task.unpack:
                         with acache.get_context(task):
@@ -381,6 +403,9 @@ def build(ctx, task, network, keep_going, default, local,
                     queue.abort()
                     raise error
 
+        # Artifacts may still be uploading in the background
+        executors.wait_for_uploads()
+
         if dag.failed:
             log.error("List of failed tasks")
             for failed in dag.failed:
@@ -404,12 +429,18 @@ def build(ctx, task, network, keep_going, default, local,
             log.warning("Interrupted again, exiting")
             _exit(1)
     finally:
+        if explain_schedule and critical_path is not None:
+            critical_path.explain()
         log.info("Total execution time: {0} {1}",
                  str(duration),
                  str(queue.duration_acc) if network else '')
+        if trace_file:
+            trace.write(trace_file)
         if result:
             with report.update() as manifest:
                 manifest.duration = str(goal_task_duration)
+                if trace.is_enabled():
+                    manifest.trace = trace.dumps()
                 manifest.write(result)
 
 
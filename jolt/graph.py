@@ -1,5 +1,6 @@
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
 import copy
+import gzip
 import hashlib
 from os import getenv
 from threading import RLock
@@ -11,8 +12,10 @@ from jolt.influence import HashInfluenceRegistry, TaskRequirementInfluence
 from jolt import log
 from jolt import utils
 from jolt import colors
+from jolt import config
 from jolt import hooks
 from jolt import filesystem as fs
+from jolt import trace
 from jolt.error import raise_error_if
 from jolt.error import raise_task_error_if
 from jolt.options import JoltOptions
@@ -33,11 +36,28 @@ class TaskProxy(object):
         self.duration_running = None
         self.requirement_aliases = {}
 
+        # Scheduling estimates, see scheduler.CriticalPath
+        self.artifact_size = 0
+        self.execution_weight = 0
+        self.transfer_weight = None
+        self.upload_weight = None
+
+        # Result of the last remote availability check, if any
+        self.available_remotely = None
+
+        # Resource demand estimates, see scheduler.ResourceQueue
+        self.cpus_estimate = None
+        self.memory_estimate = None
+
+        # Tasks executed by the same network request, see scheduler.SubgraphPartitioner
+        self.batch = None
+
         self._extended_task = None
         self._in_progress = False
         self._completed = False
         self._goal = False
         self._download = True
+        self._upload = True
         self._local = False
         self._network = False
         hooks.task_created(self)
@@ -158,7 +178,8 @@ class TaskProxy(object):
 
     def is_available_remotely(self, cache):
         tasks = [self] + self.extensions
-        return all(map(cache.is_available_remotely, tasks))
+        self.available_remotely = all(map(cache.is_available_remotely, tasks))
+        return self.available_remotely
 
     def is_cacheable(self):
         return self.task.is_cacheable()
@@ -220,6 +241,9 @@ class TaskProxy(object):
     def disable_download(self):
         self._download = False
 
+    def disable_upload(self):
+        self._upload = False
+
     def resolve_requirement_alias(self, name):
         return self.requirement_aliases.get(name)
 
@@ -329,7 +353,18 @@ class TaskProxy(object):
             else:
                 log.debug(" Retained: {} ({})", self.short_qualified_name, self.identity[:8])
 
-    def run(self, cache, force_upload=False, force_build=False):
+    def _write_build_log(self, artifact, buildlog):
+        compression = config.get("jolt", "buildlog_compression", "none")
+        raise_error_if(compression not in ["none", "gzip"],
+                       "Config: jolt.buildlog_compression must be one of 'none' or 'gzip'")
+        if compression == "gzip":
+            with gzip.open(fs.path.join(artifact.path, ".build.log.gz"), "wt", encoding="utf-8") as f:
+                buildlog.copy(f)
+        else:
+            with open(fs.path.join(artifact.path, ".build.log"), "w", encoding="utf-8") as f:
+                buildlog.copy(f)
+
+    def run(self, cache, force_upload=False, force_build=False, uploader=None):
         with self.tools:
             tasks = [self] + self.extensions
             available_locally = available_remotely = False
@@ -356,7 +391,9 @@ class TaskProxy(object):
                     if self.task.is_runnable():
                         log.verbose("Host: {0}", getenv("HOSTNAME", "localhost"))
 
-                    with cache.get_locked_artifact(self, discard=force_build) as artifact:
+                    with ExitStack() as lock:
+                        artifact = lock.enter_context(
+                            cache.get_locked_artifact(self, discard=force_build))
                         if not cache.is_available_locally(self) or self.has_extensions():
                             with cache.get_context(self) as context:
                                 self.running()
@@ -365,17 +402,17 @@ class TaskProxy(object):
                                     if self.is_goal() and self.options.debug:
                                         log.info("Entering debug shell")
                                         self.task.shell(context, self.tools)
-                                    self.task.run(context, self.tools)
+                                    with trace.span("run", task=self):
+                                        self.task.run(context, self.tools)
                                     hooks.task_postrun(self, context, self.tools)
 
                                 if not cache.is_available_locally(self):
-                                    with self.tools.cwd(self.task.joltdir):
+                                    with self.tools.cwd(self.task.joltdir), trace.span("publish", task=self):
                                         hooks.task_prepublish(self, artifact, self.tools)
                                         self.task.publish(artifact, self.tools)
                                         self.task._verify_influence(context, artifact, self.tools)
                                         hooks.task_postpublish(self, artifact, self.tools)
-                                    with open(fs.path.join(artifact.path, ".build.log"), "w") as f:
-                                        f.write(buildlog.getvalue())
+                                    self._write_build_log(artifact, buildlog)
                                     cache.commit(artifact)
                                 else:
                                     self.info("Publication skipped, already in local cache")
@@ -384,11 +421,16 @@ class TaskProxy(object):
 
                         # Must upload the artifact while still holding its lock, otherwise the
                         # artifact may become unpack():ed before we have a chance to.
-                        if force_upload or force_build or not available_remotely:
-                            raise_task_error_if(
-                                not cache.upload(self, force=force_upload, locked=False) and cache.upload_enabled(),
-                                self, "failed to upload task artifact")
-            elif force_upload or not available_remotely:
+                        # An uploader takes over the lock and releases it once the
+                        # artifact has been transferred.
+                        if self._upload and (force_upload or force_build or not available_remotely):
+                            if uploader is not None and cache.upload_enabled():
+                                uploader(self, lock.pop_all(), force_upload)
+                            else:
+                                raise_task_error_if(
+                                    not cache.upload(self, force=force_upload, locked=False) and cache.upload_enabled(),
+                                    self, "failed to upload task artifact")
+            elif self._upload and (force_upload or not available_remotely):
                 raise_task_error_if(
                     not cache.upload(self, force=force_upload) and cache.upload_enabled(),
                     self, "failed to upload task artifact")
@@ -397,7 +439,7 @@ class TaskProxy(object):
                 try:
                     extension.started()
                     with hooks.task_run(extension):
-                        extension.run(cache, force_upload, force_build)
+                        extension.run(cache, force_upload, force_build, uploader)
                 except Exception as e:
                     extension.failed()
                     raise e
@@ -596,13 +638,15 @@ class GraphBuilder(object):
                 yield p
 
     def build(self, task_list, influence=True):
-        with self._progress("Building graph", len(self.graph.tasks), "tasks") as progress:
+        with self._progress("Building graph", len(self.graph.tasks), "tasks") as progress, \
+             trace.span("Building graph"):
             goals = [self._get_node(progress, task) for task in task_list]
             self.graph._nodes_by_name = self.nodes
 
         if influence:
             topological_nodes = self.graph.topological_nodes
-            with self._progress("Collecting task influence", len(self.graph.tasks), "tasks") as p:
+            with self._progress("Collecting task influence", len(self.graph.tasks), "tasks") as p, \
+                 trace.span("Collecting task influence"):
                 for node in reversed(topological_nodes):
                     node.finalize(self.graph, self.manifest)
                     p.update(1)
@@ -610,6 +654,7 @@ class GraphBuilder(object):
             max_time = 0
             min_time = 0
             for node in topological_nodes:
+                node.execution_weight = node.task.weight
                 max_time += node.task.weight
                 node.task.weight += max([a.weight for a in node.ancestors] + [0])
                 min_time = max(node.task.weight, min_time)
@@ -654,7 +699,7 @@ class GraphPruner(object):
             utils.map_concurrent(self._check_node, node.neighbors)
 
     def prune(self, graph):
-        with log.progress("Checking availability", 0, " tasks") as p:
+        with log.progress("Checking availability", 0, " tasks") as p, trace.span("Checking availability"):
             self._progress = p
             for root in graph.roots:
                 self._check_node(root)
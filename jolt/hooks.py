@@ -1,4 +1,4 @@
-from contextlib import contextmanager, ExitStack
+from contextlib import contextmanager, nullcontext, ExitStack
 import functools
 
 from jolt import utils
@@ -33,6 +33,14 @@ class TaskHook(object):
     def task_finished_upload(self, task):
         """ Called before task_finished, if the task artifact was uploaded """
 
+    def task_downloaded(self, task, seconds):
+        """ Called whenever the task artifact has been downloaded,
+        with the time spent transferring it """
+
+    def task_uploaded(self, task, seconds):
+        """ Called whenever the task artifact has been uploaded,
+        with the time spent transferring it """
+
     def task_failed(self, task):
         pass
 
@@ -48,7 +56,7 @@ class TaskHook(object):
     def task_prepublish(self, task, artifact, tools):
         pass
 
-    def task_prenunpack(self, task, artifact, tools):
+    def task_preunpack(self, task, artifact, tools):
         pass
 
     def task_postrun(self, task, deps, tools):
@@ -65,6 +73,9 @@ class TaskHook(object):
         yield
 
 
+_TASK_HOOK_EVENTS = [name for name in dir(TaskHook) if name.startswith("task_")]
+
+
 class TaskHookFactory(object):
     @staticmethod
     def register(cls):
@@ -91,121 +102,102 @@ class TaskHookRegistry(object):
         self.hooks = [factory().create(env) for factory, _ in TaskHookRegistry.factories]
         self.hooks = list(filter(lambda n: n, self.hooks))
 
+        # Hook methods to call for each event. Hooks which don't
+        # override an event, i.e. inherit the no-op method of
+        # TaskHook, are left out.
+        self._dispatch = {
+            event: [getattr(ext, event) for ext in self.hooks if self._implements(ext, event)]
+            for event in _TASK_HOOK_EVENTS
+        }
+
+    @staticmethod
+    def _implements(ext, event):
+        if event in getattr(ext, "__dict__", {}):
+            return True
+        method = getattr(type(ext), event, None)
+        return method is not None and method is not getattr(TaskHook, event)
+
+    def _call(self, methods, task, *args):
+        if not methods or task.is_resource():
+            return
+        for method in methods:
+            utils.call_and_catch_and_log(method, task, *args)
+
     def task_created(self, task):
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_created, task)
+        for method in self._dispatch["task_created"]:
+            utils.call_and_catch_and_log(method, task)
 
     def task_started(self, task):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_started, task)
+        self._call(self._dispatch["task_started"], task)
 
     def task_started_download(self, task):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_started_download, task)
+        self._call(self._dispatch["task_started_download"], task)
 
     def task_started_execution(self, task):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_started_execution, task)
+        self._call(self._dispatch["task_started_execution"], task)
 
     def task_started_upload(self, task):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_started_upload, task)
+        self._call(self._dispatch["task_started_upload"], task)
 
     def task_finished(self, task):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_finished, task)
+        self._call(self._dispatch["task_finished"], task)
 
     def task_finished_download(self, task):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_finished_download, task)
+        self._call(self._dispatch["task_finished_download"], task)
 
     def task_finished_execution(self, task):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_finished_execution, task)
+        self._call(self._dispatch["task_finished_execution"], task)
 
     def task_finished_upload(self, task):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_finished_upload, task)
+        self._call(self._dispatch["task_finished_upload"], task)
+
+    def task_downloaded(self, task, seconds):
+        self._call(self._dispatch["task_downloaded"], task, seconds)
+
+    def task_uploaded(self, task, seconds):
+        self._call(self._dispatch["task_uploaded"], task, seconds)
 
     def task_failed(self, task):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_failed, task)
+        self._call(self._dispatch["task_failed"], task)
 
     def task_pruned(self, task):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_pruned, task)
+        self._call(self._dispatch["task_pruned"], task)
 
     def task_skipped(self, task):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_skipped, task)
+        self._call(self._dispatch["task_skipped"], task)
 
     def task_prerun(self, task, deps, tools):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_prerun, task, deps, tools)
+        self._call(self._dispatch["task_prerun"], task, deps, tools)
 
     def task_prepublish(self, task, artifact, tools):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_prepublish, task, artifact, tools)
+        self._call(self._dispatch["task_prepublish"], task, artifact, tools)
 
     def task_preunpack(self, task, artifact, tools):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_preunpack, task, artifact, tools)
+        self._call(self._dispatch["task_preunpack"], task, artifact, tools)
 
     def task_postrun(self, task, deps, tools):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_postrun, task, deps, tools)
+        self._call(self._dispatch["task_postrun"], task, deps, tools)
 
     def task_postpublish(self, task, artifact, tools):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_postpublish, task, artifact, tools)
+        self._call(self._dispatch["task_postpublish"], task, artifact, tools)
 
     def task_postunpack(self, task, artifact, tools):
-        if task.is_resource():
-            return
-        for ext in self.hooks:
-            utils.call_and_catch_and_log(ext.task_postunpack, task, artifact, tools)
+        self._call(self._dispatch["task_postunpack"], task, artifact, tools)
 
-    @contextmanager
     def task_run(self, task):
+        methods = self._dispatch["task_run"]
         tasks = [task] if type(task) != list else task
+        tasks = [task for task in tasks if not task.is_resource()]
+        if not methods or not tasks:
+            return nullcontext()
+        return self._task_run(methods, tasks)
+
+    @contextmanager
+    def _task_run(self, methods, tasks):
         with ExitStack() as stack:
             for task in tasks:
-                if task.is_resource():
-                    continue
-                for ext in self.hooks:
-                    stack.enter_context(ext.task_run(task))
+                for method in methods:
+                    stack.enter_context(method(task))
             yield
 
 
@@ -292,6 +284,14 @@ def task_finished_upload(task):
     TaskHookRegistry.get().task_finished_upload(task)
 
 
+def task_downloaded(task, seconds):
+    TaskHookRegistry.get().task_downloaded(task, seconds)
+
+
+def task_uploaded(task, seconds):
+    TaskHookRegistry.get().task_uploaded(task, seconds)
+
+
 def task_pruned(task):
     TaskHookRegistry.get().task_pruned(task)
 
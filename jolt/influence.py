@@ -159,7 +159,7 @@ class TaskSourceInfluence(HashInfluenceProvider):
             try:
                 func.__influence
             except AttributeError:
-                func.__influence = utils.sha1(inspection.getfuncsource(func))
+                func.__influence = inspection.getfuncdigest(func)
             finally:
                 shasum.update(func.__influence.encode())
 
@@ -210,7 +210,7 @@ class TaskClassSourceInfluence(HashInfluenceProvider):
                 cls.__dict__["_TaskClassSourceInfluence__influence"]
             except KeyError:
                 try:
-                    cls.__influence = utils.sha1(inspection.getclasssource(cls))
+                    cls.__influence = inspection.getclassdigest(cls)
                 except TypeError:
                     continue
             result += cls.__dict__["_TaskClassSourceInfluence__influence"] + \
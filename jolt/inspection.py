@@ -7,15 +7,30 @@ down the builtin inspect module's source lookup functions.
 Unlike the builtin module, this implementation caches the AST
 of already parsed modules in order to speed up those functions.
 
+Source digests of classes and functions are also cached, both in
+memory and on disk next to the module's bytecode cache. The persistent
+cache is keyed by the modification time and size of the source file
+so that unmodified recipes don't have to be parsed at all.
+
 """
 
 import ast
+import atexit
+import hashlib
+import importlib.util
+import json
+import os
 import sys
+import threading
 
 
 # Cache of parsed modules (ClassFinder objects), indexed by module.
 _modules = {}
 
+# Cache of source digests (DigestCache objects), indexed by module.
+_digests = {}
+_digests_lock = threading.Lock()
+
 
 def _populate_cache(module):
     global _modules
@@ -135,3 +150,83 @@ def getmoduleclasses(module, searchtypes, predicate=None):
                     classes[searchtype].append(obj)
 
     return classes
+
+
+class _DigestCache(object):
+    """ Persistent cache of source digests for classes and functions in a module. """
+
+    def __init__(self, module):
+        self.path = None
+        self.key = None
+        self.digests = {}
+        self.dirty = False
+
+        try:
+            stat = os.stat(module.__file__)
+            self.key = [stat.st_mtime_ns, stat.st_size, sys.version]
+            if not sys.dont_write_bytecode:
+                pyc = importlib.util.cache_from_source(module.__file__)
+                self.path = os.path.splitext(pyc)[0] + ".digests.json"
+        except Exception:
+            return
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data["key"] == self.key:
+                self.digests = data["digests"]
+        except Exception:
+            pass
+
+    def get(self, name, source):
+        digest = self.digests.get(name)
+        if digest is None:
+            digest = self.digests[name] = hashlib.sha1(source().encode()).hexdigest()
+            self.dirty = True
+        return digest
+
+    def save(self):
+        if not self.dirty or not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".{}".format(os.getpid())
+            with open(tmp, "w") as f:
+                json.dump({"key": self.key, "digests": self.digests}, f)
+            os.replace(tmp, self.path)
+            self.dirty = False
+        except Exception:
+            pass
+
+
+def _get_digest_cache(module):
+    with _digests_lock:
+        cache = _digests.get(module)
+        if cache is None:
+            cache = _digests[module] = _DigestCache(module)
+        return cache
+
+
+@atexit.register
+def _save_digest_caches():
+    with _digests_lock:
+        for cache in _digests.values():
+            cache.save()
+
+
+def getclassdigest(cls):
+    """ Returns the SHA1 digest of the source code of a class """
+    module = getmodule(cls)
+    if not getattr(module, '__file__', None):
+        raise TypeError('{!r} is a built-in object'.format(cls))
+    cache = _get_digest_cache(module)
+    return cache.get("class:" + cls.__qualname__, lambda: getclasssource(cls))
+
+
+def getfuncdigest(func):
+    """ Returns the SHA1 digest of the source code of a function """
+    module = getmodule(func)
+    if not getattr(module, '__file__', None):
+        raise TypeError('{!r} is a built-in object'.format(func))
+    cache = _get_digest_cache(module)
+    return cache.get("func:" + func.__qualname__, lambda: getfuncsource(func))
@@ -53,11 +53,17 @@ class NativeRecipe(Recipe):
         super(NativeRecipe, self).load()
 
         name = utils.canonical(self.path)
-        loader = SourceFileLoader("joltfile_{0}".format(name), self.path)
-        module = ModuleType(loader.name)
-        module.__file__ = self.path
-        loader.exec_module(module)
-        sys.modules[loader.name] = module
+        code = _get_preloaded(self.path, self.source)
+        if code is None:
+            loader = SourceFileLoader("joltfile_{0}".format(name), self.path)
+            module = ModuleType(loader.name)
+            module.__file__ = self.path
+            loader.exec_module(module)
+        else:
+            module = ModuleType("joltfile_{0}".format(name))
+            module.__file__ = self.path
+            exec(code, module.__dict__)
+        sys.modules[module.__name__] = module
 
         classes = inspection.getmoduleclasses(module, [Task, TaskGenerator], NativeRecipe._is_abstract)
         generators = []
@@ -79,6 +85,34 @@ class NativeRecipe(Recipe):
         log.verbose("Loaded: {0}", self.path)
 
 
+_preloaded = {}
+
+
+def preload(path, source):
+    """
+    Compiles a recipe ahead of time.
+
+    Used by resident workers to keep recipes compiled between builds.
+    Processes forked after the recipe has been preloaded execute the
+    compiled code instead of parsing the recipe again, as long as the
+    recipe source is unchanged. The recipe itself is never executed
+    by this function, so the side effects of recipe code such as
+    registered hooks and influence are confined to the build that
+    loads the recipe.
+    """
+    digest = utils.sha1(source)
+    if path in _preloaded and _preloaded[path][0] == digest:
+        return
+    _preloaded[path] = (digest, compile(source, path, "exec"))
+
+
+def _get_preloaded(path, source):
+    if path not in _preloaded:
+        return None
+    digest, code = _preloaded[path]
+    return code if digest == utils.sha1(source) else None
+
+
 class Loader(object):
     def recipes(self):
         pass
@@ -1,7 +1,9 @@
 from __future__ import print_function
 import os
 import re
+import shutil
 import sys
+import tempfile
 import tqdm
 if os.name == "nt":
     # FIXME: Workaround to make tqdm behave correctly on Windows
@@ -14,10 +16,6 @@ import threading
 import logging
 import logging.handlers
 from contextlib import contextmanager
-try:
-    from StringIO import StringIO
-except Exception:
-    from io import StringIO
 
 from jolt import config
 from jolt.error import JoltError
@@ -29,6 +27,7 @@ default_path = fs.path.join(config.get_logpath(), "jolt.log")
 logfile = config.get("jolt", "logfile", default_path)
 logsize = config.getsize("jolt", "logsize", os.environ.get("JOLT_LOGSIZE", 10 * 1024 ** 2))  # 10MiB
 logcount = config.getint("jolt", "logcount", os.environ.get("JOLT_LOGCOUNT", 1))
+logspool = config.getsize("jolt", "logspool", 1024 ** 2)  # 1MiB
 
 dirpath = fs.path.dirname(logfile)
 if not fs.path.exists(dirpath):
@@ -345,10 +344,93 @@ class _ThreadMapper(Filter):
 _thread_map = _ThreadMapper()
 
 
+class SpooledBuffer(object):
+    """
+    Text buffer with bounded memory usage.
+
+    Text is kept in memory until the buffer exceeds ``jolt.logspool``
+    bytes, after which the buffer is moved to a temporary file.
+    """
+
+    def __init__(self, max_size=None):
+        self._lock = threading.Lock()
+        self._file = tempfile.SpooledTemporaryFile(
+            max_size=max_size if max_size is not None else logspool,
+            mode="w+", encoding="utf-8", errors="replace", newline="\n")
+
+    def write(self, data):
+        with self._lock:
+            self._file.write(data)
+
+    def flush(self):
+        pass
+
+    def copy(self, fileobj):
+        """ Copies the buffer to a text file object, without reading it into memory. """
+        with self._lock:
+            self._file.seek(0)
+            try:
+                shutil.copyfileobj(self._file, fileobj)
+            finally:
+                self._file.seek(0, os.SEEK_END)
+
+    def lines(self):
+        """ Returns an iterator over the lines in the buffer, with line endings. """
+        with self._lock:
+            self._file.seek(0)
+            try:
+                for line in self._file:
+                    yield line
+            finally:
+                self._file.seek(0, os.SEEK_END)
+
+    def truncated(self, max_size):
+        """
+        Returns the beginning and the end of the buffer.
+
+        At most max_size characters are returned, without reading the
+        whole buffer into memory. The result is a tuple of the beginning,
+        the number of characters left out and the end.
+        """
+        with self._lock:
+            self._file.seek(0)
+            try:
+                data = self._file.read(max_size + 1)
+                if len(data) <= max_size:
+                    return data, 0, ""
+                head, tail = data[:max_size // 2], data[max_size // 2:]
+                size = max_size - len(head)
+                total = len(data)
+                for chunk in iter(lambda: self._file.read(max(size, 65536)), ""):
+                    total += len(chunk)
+                    tail = (tail + chunk)[-size:]
+                tail = tail[-size:] if size > 0 else ""
+                return head, total - len(head) - len(tail), tail
+            finally:
+                self._file.seek(0, os.SEEK_END)
+
+    def getvalue(self):
+        with self._lock:
+            self._file.seek(0)
+            try:
+                return self._file.read()
+            finally:
+                self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        self._file.close()
+
+
 @contextmanager
 def threadsink(level=DEBUG):
+    """
+    Captures log records of the calling thread in a SpooledBuffer.
+
+    The buffer is closed when the context exits and must be read
+    before then.
+    """
     threadid = threading.get_ident()
-    stringbuf = StringIO()
+    stringbuf = SpooledBuffer()
     handler = logging.StreamHandler(stringbuf)
     handler.setLevel(level)
     handler.setFormatter(_file_formatter)
@@ -359,6 +441,7 @@ def threadsink(level=DEBUG):
         yield stringbuf
     finally:
         _logger.removeHandler(handler)
+        stringbuf.close()
 
 
 @contextmanager
@@ -371,6 +454,63 @@ def map_thread(thread_from, thread_to):
         _thread_map.unmap(tid)
 
 
+class _ForwardHandler(logging.Handler):
+    """ Forwards log records to another process, see forward() and replay(). """
+
+    def __init__(self, send):
+        super(_ForwardHandler, self).__init__(DEBUG)
+        self._send = send
+
+    def emit(self, record):
+        try:
+            message = record.msg.format(*record.args)
+        except Exception:
+            message = record.msg
+        try:
+            self._send((record.levelno, message, record.__dict__.get("prefix", False)))
+        except Exception:
+            pass
+
+
+def forward(send):
+    """
+    Forwards all log records of this process using the send function.
+
+    Used in child processes to transfer their log output to the parent
+    process, where the records are replayed with replay().
+    """
+    for handler in list(_logger.handlers):
+        _logger.removeHandler(handler)
+    _logger.addHandler(_ForwardHandler(send))
+
+
+@contextmanager
+def threadforward(send, level=DEBUG):
+    """
+    Forwards log records of the calling thread using the send function.
+
+    Records are forwarded in the same format as with forward().
+    """
+    threadid = threading.get_ident()
+    handler = _ForwardHandler(send)
+    handler.setLevel(level)
+    handler.addFilter(_thread_map)
+    handler.addFilter(Filter(lambda record: record.thread == threadid))
+    _logger.addHandler(handler)
+    try:
+        yield
+    finally:
+        _logger.removeHandler(handler)
+
+
+def replay(record):
+    """ Logs a record forwarded by a child process. """
+    level, message, prefix = record
+    message = message.replace("{", "{{")
+    message = message.replace("}", "}}")
+    _logger.log(level, message, extra={"prefix": prefix})
+
+
 class _LogStream(object):
     def __init__(self):
         self.buf = ""
@@ -1,12 +1,56 @@
 from xml.dom import minidom
 from xml.etree import ElementTree as ET
+import json
 import os
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from jolt.xmldom import Attribute, Composition, SubElement, Element, ElementTree
 from jolt import filesystem as fs
 from jolt import log
 
 
+# Serialization formats
+FORMAT_XML = "xml"
+FORMAT_JSON = "json"
+FORMAT_JSON_ZLIB = "json+zlib"
+FORMAT_JSON_ZSTD = "json+zstd"
+
+
+def get_formats():
+    """ Returns the supported serialization formats, in order of preference. """
+    formats = [FORMAT_JSON_ZLIB, FORMAT_JSON, FORMAT_XML]
+    if zstandard is not None:
+        formats.insert(0, FORMAT_JSON_ZSTD)
+    return formats
+
+
+def select_format(accepted):
+    """ Returns the preferred format among those accepted by a peer, or XML. """
+    accepted = accepted.split(",") if accepted else []
+    for fmt in get_formats():
+        if fmt in accepted:
+            return fmt
+    return FORMAT_XML
+
+
+def _element_to_list(elem):
+    children = [_element_to_list(child) for child in elem]
+    return [elem.tag, elem.attrib, elem.text, children]
+
+
+def _list_to_element(data):
+    tag, attrib, text, children = data
+    elem = Element(tag, attrib)
+    elem.text = text
+    for child in children:
+        elem.append(_list_to_element(child))
+    return elem
+
+
 @Attribute('name')
 @Attribute('value', child=True)
 class _JoltAttribute(SubElement):
@@ -104,8 +148,10 @@ class _JoltNetworkParameter(SubElement):
 @Attribute("stderr", child=True, zlib=True)
 @Attribute("result", child=True)
 @Attribute("duration", child=True)
+@Attribute("trace", child=True, zlib=True)
 @Attribute("workspace")
 @Attribute("version")
+@Attribute("bundle")
 @Composition(_JoltRecipe, "recipe")
 @Composition(_JoltTask, "task")
 @Composition(_JoltBuild, "build")
@@ -175,6 +221,40 @@ class JoltManifest(ElementTree):
     def format(self):
         return minidom.parseString(ET.tostring(self.getroot())).toprettyxml(indent="  ")
 
+    def encode(self, fmt=FORMAT_XML):
+        """
+        Serializes the manifest into bytes.
+
+        The JSON formats are more compact and faster to produce and parse
+        than XML. They are used on the wire between clients and workers
+        when both sides support them. XML is used for everything else.
+        """
+        if fmt == FORMAT_XML:
+            return self.format().encode()
+        data = json.dumps(_element_to_list(self.getroot()), separators=(",", ":")).encode()
+        if fmt == FORMAT_JSON:
+            return data
+        if fmt == FORMAT_JSON_ZLIB:
+            return zlib.compress(data)
+        if fmt == FORMAT_JSON_ZSTD and zstandard is not None:
+            return zstandard.ZstdCompressor().compress(data)
+        raise ValueError("unsupported manifest format: {}".format(fmt))
+
+    def decode(self, data, fmt=FORMAT_XML):
+        """ Parses a manifest serialized with encode() """
+        if fmt == FORMAT_XML:
+            return self.parsestring(data)
+        if fmt == FORMAT_JSON_ZLIB:
+            data = zlib.decompress(data)
+        elif fmt == FORMAT_JSON_ZSTD and zstandard is not None:
+            data = zstandard.ZstdDecompressor().decompress(data)
+        elif fmt != FORMAT_JSON:
+            raise ValueError("unsupported manifest format: {}".format(fmt))
+        root = _list_to_element(json.loads(data))
+        self._setroot(root)
+        self._elem = root
+        return self
+
     def transform(self, xsltfile):
         from lxml import etree as lxmlET
         manifest = lxmlET.fromstring(self.format())
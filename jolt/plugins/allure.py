@@ -212,10 +212,10 @@ class AllureHooks(TaskHook):
         task.allure_logsink_buffer = task.allure_logsink.__enter__()
 
     def _task_ended(self, task, status):
+        content = task.allure_logsink_buffer.getvalue()
         task.allure_logsink.__exit__(None, None, None)
         with task.allure_lifecycle.update_test_case() as result:
             with task.tools.cwd(self._logpath):
-                content = task.allure_logsink_buffer.getvalue()
                 if content:
                     logpath = utils.sha1(content) + "-" + "log"
                     task.tools.write_file(logpath, content, expand=False)
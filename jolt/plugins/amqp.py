@@ -1,32 +1,51 @@
+import atexit
 import click
+import collections
+from concurrent.futures import Future, TimeoutError
+from contextlib import contextmanager
 import functools
 import getpass
+import json
 import keyring
+import logging
+from multiprocessing.connection import Connection
 import os
 try:
     import pika
-    from pika.exceptions import AMQPConnectionError
-    from pika.adapters.utils.connection_workflow import AMQPConnectorStackTimeout
 except ImportError:
     from jolt import log
     log.error("AMQP plugin enabled but not installed. Install it with: pip install jolt[amqp]")
     os._exit(1)
 
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
 import threading
 import time
+import uuid
+import zlib
 
+import jolt.__main__ as jolt_main
+import jolt.cli as jolt_cli
 from jolt.cli import cli
+from jolt import cache
 from jolt import config
 from jolt import filesystem as fs
-from jolt import hooks
+from jolt import loader
 from jolt import log
 from jolt import scheduler
 from jolt import utils
+from jolt.graph import GraphBuilder
 from jolt.manifest import JoltManifest
+from jolt.manifest import FORMAT_JSON_ZLIB, FORMAT_XML
+from jolt.manifest import get_formats, select_format
+from jolt.tasks import Task, TaskRegistry
 from jolt.tools import Tools
 from jolt.error import JoltCommandError
-from jolt.error import raise_error
-from jolt.error import raise_task_error_if
+from jolt.error import JoltError
+from jolt.error import raise_error_if
 from jolt.error import raise_task_error_on_exception
 
 
@@ -55,10 +74,359 @@ def _get_url():
     return "amqp://{}:{}@{}:{}/%2F".format(username, password, host, port)
 
 
-TYPE = "Remote execution"
 TIMEOUT = (3.5, 27)
 POLL_INTERVAL = 1
 
+# Workers advertise their cache contents at this interval, in seconds.
+# Advertisements older than three intervals are discarded by clients.
+SUMMARY_INTERVAL = 10
+
+# Message headers carrying the serialization format of a manifest
+# and the formats accepted in a response, respectively.
+HEADER_FORMAT = "x-jolt-manifest"
+HEADER_ACCEPT = "x-jolt-manifest-accept"
+
+# Message header requesting, or marking, a batch of streamed log lines
+HEADER_LOG = "x-jolt-log"
+
+# Streamed log lines are published at this interval, in seconds.
+# At most LOG_BUFFER lines are buffered, older lines are dropped.
+LOG_INTERVAL = 1
+LOG_BUFFER = 10000
+
+# Number of trailing stdout/stderr lines kept in the result of
+# a failed task when the output has also been streamed.
+LOG_TAIL = 100
+
+# Name of the marker file recording the recipe bundle installed in a workspace
+BUNDLE_MARKER = ".jolt-recipes"
+
+
+class RecipeBundle(Task):
+    """
+    The recipes of the client workspace, published to the artifact cache.
+
+    The identity of the artifact is the digest of the recipes rather than
+    the regular task identity. Requests reference the bundle by digest
+    instead of inlining recipe sources and workers download it once.
+    """
+
+    name = "jolt/recipes"
+
+    def publish(self, artifact, tools):
+        with tools.cwd(tools.builddir()):
+            for recipe in loader.JoltLoader.get().recipes:
+                tools.write_file(recipe.basepath, recipe.source, expand=False)
+                artifact.collect(recipe.basepath)
+
+
+def _get_recipe_digest(recipes):
+    recipes = sorted(recipes, key=lambda recipe: recipe.basepath)
+    return utils.sha1("".join(
+        "{}\0{}\0".format(recipe.basepath, recipe.source) for recipe in recipes))
+
+
+def _get_recipe_bundle_node(digest):
+    registry = TaskRegistry()
+    registry.add_task_class(RecipeBundle)
+    gb = GraphBuilder(registry, JoltManifest())
+    dag = gb.build([RecipeBundle.name])
+    nodes = dag.select(lambda graph, task: True)
+    assert len(nodes) == 1, "too many recipe bundle tasks found"
+    node = nodes[0]
+    node.identity = digest
+    return node
+
+
+def publish_recipe_bundle():
+    """ Publishes the workspace recipes to the remote cache and returns their digest. """
+    digest = _get_recipe_digest(loader.JoltLoader.get().recipes)
+    node = _get_recipe_bundle_node(digest)
+    acache = cache.ArtifactCache.get()
+    if not acache.is_available_remotely(node):
+        executor = scheduler.LocalExecutor(scheduler.LocalExecutorFactory(), node, force_upload=True)
+        executor.run(scheduler.JoltEnvironment(cache=acache))
+        raise_error_if(not acache.is_available_remotely(node),
+                       "failed to publish recipe bundle to a remote cache")
+    log.verbose("[AMQP] Recipe bundle: {}", digest)
+    return digest
+
+
+def install_recipe_bundle(workdir, digest):
+    """
+    Installs a recipe bundle in a workspace.
+
+    Bundles are downloaded to the local artifact cache and are only
+    copied to the workspace if it doesn't already contain the same bundle.
+    """
+    tools = Tools(cwd=workdir)
+    marker = fs.path.join(workdir, BUNDLE_MARKER)
+    if fs.path.exists(marker) and tools.read_file(marker) == digest:
+        log.info("Recipes unchanged")
+        return
+
+    # The worker itself may not be running in a workspace
+    loader.JoltLoader.get().set_joltdir(workdir)
+
+    acache = cache.ArtifactCache.get()
+    node = _get_recipe_bundle_node(digest)
+    if not acache.is_available_locally(node):
+        raise_error_if(not acache.download(node, force=True) or not acache.is_available_locally(node),
+                       "failed to download recipe bundle {}", digest)
+
+    if fs.path.exists(marker):
+        tools.unlink(marker)
+    for recipe in tools.glob("*.jolt"):
+        tools.unlink(recipe)
+    with acache.get_artifact(node) as artifact:
+        for recipe in Tools(cwd=artifact.path).glob("*.jolt"):
+            tools.copy(fs.path.join(artifact.path, recipe), recipe)
+    tools.write_file(marker, digest)
+    log.info("Recipes installed: {}", digest[:8])
+
+
+def selfdeploy_venv(tools, src):
+    """
+    Returns a virtualenv with the pinned dependencies of a Jolt version.
+
+    Environments are pooled by the digest of the requirements and
+    shared by all Jolt versions with the same dependencies. Jolt
+    itself is installed separately for each version.
+    """
+    requirements = tools.read_file(fs.path.join(src, "requirements.txt"))
+    digest = utils.sha1(requirements)[:16]
+    venv = tools.expand_path("build/selfdeploy/venv/{}", digest)
+    if not fs.path.exists(venv):
+        try:
+            tools.run("virtualenv {}", venv)
+            tools.run("{}/bin/pip install -q --no-index --find-links {}/wheelhouse -r {}/requirements.txt",
+                      venv, src, src)
+        except Exception as e:
+            tools.rmtree(venv, ignore_errors=True)
+            raise e
+    return venv
+
+
+def install_wheelhouse(tools, src, lib):
+    """
+    Installs a deployed Jolt version offline from its wheelhouse.
+
+    Jolt is installed into lib and its dependencies into a pooled
+    virtualenv. Returns the command which runs the installed Jolt,
+    or None if the deployment has no wheelhouse or if its wheels,
+    built on the client, can't be installed on this host. Jolt must
+    then be installed from sources instead.
+    """
+    if not fs.path.exists(fs.path.join(src, "wheelhouse")) or \
+       not fs.path.exists(fs.path.join(src, "requirements.txt")):
+        return None
+    try:
+        venv = selfdeploy_venv(tools, src)
+        tools.run("{}/bin/pip install -q --no-index --no-deps --target {} {}/wheelhouse/jolt-*.whl",
+                  venv, lib, src)
+        return ". {}/bin/activate && PYTHONPATH={} python -m jolt".format(venv, lib)
+    except Exception as e:
+        tools.rmtree(lib, ignore_errors=True)
+        log.warning("Failed to install Jolt from wheelhouse, installing from sources: {}", e)
+        return None
+
+
+class LogStream(object):
+    """
+    Streams the log of a job to the client.
+
+    Log records are buffered and published in zlib compressed batches
+    at a fixed interval. The buffer is bounded and the oldest lines are
+    dropped if records are logged faster than they can be published.
+    """
+
+    def __init__(self, publish, interval=LOG_INTERVAL, size=LOG_BUFFER):
+        self._publish = publish
+        self._interval = interval
+        self._lines = collections.deque(maxlen=size)
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+        return False
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.flush()
+
+    def write(self, record):
+        """ Buffers a log record, as forwarded by log.threadforward() """
+        levelno, message, _ = record
+        if levelno not in [log.STDOUT, log.STDERR]:
+            message = "[{:>7}] {}".format(logging.getLevelName(levelno), message)
+        with self._lock:
+            if len(self._lines) == self._lines.maxlen:
+                self._dropped += 1
+            self._lines.append(message)
+
+    def flush(self):
+        with self._lock:
+            lines = list(self._lines)
+            dropped = self._dropped
+            self._lines.clear()
+            self._dropped = 0
+        if dropped:
+            lines.insert(0, "[WARNING] {} log lines dropped".format(dropped))
+        if lines:
+            self._publish(zlib.compress("\n".join(lines).encode()))
+
+
+class LogTail(threading.Thread):
+    """
+    Follows a log file written by another process.
+
+    Complete lines are passed to the output function as they are
+    written. The thread logs on behalf of the thread creating it.
+    """
+
+    def __init__(self, path, output, interval=0.1):
+        super(LogTail, self).__init__(daemon=True)
+        self.path = path
+        self.output = output
+        self.interval = interval
+        self.lines = []
+        self._parent = threading.current_thread()
+        self._stopped = threading.Event()
+        self.start()
+
+    def run(self):
+        with log.map_thread(self, self._parent):
+            f = None
+            buf = ""
+            try:
+                while True:
+                    stopped = self._stopped.is_set()
+                    if f is None and fs.path.exists(self.path):
+                        f = open(self.path, errors="ignore")
+                    if f is not None:
+                        buf += f.read()
+                        *lines, buf = buf.split("\n")
+                        for line in lines:
+                            self.lines.append(line)
+                            self.output(line)
+                    if stopped:
+                        break
+                    self._stopped.wait(self.interval)
+                if buf:
+                    self.lines.append(buf)
+                    self.output(buf)
+            finally:
+                if f is not None:
+                    f.close()
+
+    def stop(self):
+        """ Stops following the file after reading what remains of it. """
+        self._stopped.set()
+        self.join()
+
+
+class ResidentWorker(object):
+    """
+    A warm Jolt process executing builds on behalf of the AMQP worker.
+
+    The process is started once per Jolt version with the ``amqp-resident``
+    command. It has already imported Jolt and its plugins when a build
+    request arrives and forks a child process to run the build instead of
+    starting a new interpreter. Recipes are compiled, but never executed,
+    in the resident process and the code is reused by later builds as long
+    as their source is unchanged.
+    """
+
+    def __init__(self, jolt, config_file):
+        self._tmpdir = tempfile.mkdtemp(prefix="jolt-resident-")
+        self.address = fs.path.join(self._tmpdir, "socket")
+        self._process = subprocess.Popen(
+            "{} {} amqp-resident {}".format(jolt, config_file, self.address),
+            shell=True, start_new_session=True)
+
+    def _connect(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.address)
+                return Connection(sock.detach())
+            except OSError:
+                sock.close()
+                raise_error_if(not self.is_alive(), "Resident worker terminated unexpectedly")
+                raise_error_if(deadline is not None and time.time() > deadline,
+                               "Resident worker failed to start")
+                time.sleep(0.1)
+
+    def wait_ready(self, timeout=60):
+        self._connect(timeout).close()
+
+    def is_alive(self):
+        return self._process.poll() is None
+
+    def build(self, workdir, args):
+        """ Runs Jolt with the given arguments in workdir, returns the exit status """
+        conn = self._connect()
+        try:
+            conn.send((workdir, args))
+            return conn.recv()
+        finally:
+            conn.close()
+
+    def stop(self):
+        if self.is_alive():
+            utils.call_and_catch(os.killpg, self._process.pid, signal.SIGTERM)
+            self._process.wait()
+        fs.rmtree(self._tmpdir, ignore_errors=True)
+
+
+_resident_lock = threading.Lock()
+_resident_workers = {}
+_resident_failures = set()
+
+
+def _get_resident_worker(jolt, config_file):
+    """
+    Returns a resident worker for a Jolt version, starting one if needed.
+
+    Returns None if the version doesn't support resident workers.
+    """
+    key = (jolt, config_file)
+    with _resident_lock:
+        if key in _resident_failures:
+            return None
+        worker = _resident_workers.get(key)
+        if worker is not None and worker.is_alive():
+            return worker
+        log.info("Starting resident worker")
+        worker = ResidentWorker(jolt, config_file)
+        try:
+            worker.wait_ready()
+        except Exception as e:
+            log.warning("Resident worker unavailable, falling back to one process per task: {}", e)
+            worker.stop()
+            _resident_failures.add(key)
+            return None
+        _resident_workers[key] = worker
+        return worker
+
+
+@atexit.register
+def _stop_resident_workers():
+    with _resident_lock:
+        for worker in _resident_workers.values():
+            worker.stop()
+        _resident_workers.clear()
+
 
 class WorkerTaskConsumer(object):
     """This is a task consumer that will handle unexpected interactions
@@ -77,6 +445,7 @@ class WorkerTaskConsumer(object):
     EXCHANGE_TYPE = 'direct'
     QUEUE = 'jolt_tasks'
     RESULT_EXCHANGE = 'jolt_results'
+    SUMMARY_EXCHANGE = 'jolt_cache_summaries'
     ROUTING_KEY_PREFIX = ''
     ROUTING_KEY_REQUEST = 'default'
     ROUTING_KEY_RESULT = 'default'
@@ -97,15 +466,27 @@ class WorkerTaskConsumer(object):
         self._consumer_tag = None
         self._url = amqp_url
         self._consuming = False
-        # In production, experiment with higher prefetch values
-        # for higher consumer throughput
-        self._prefetch_count = 1
-        self._job = None
+        # Each slot executes one job at a time. The broker delivers
+        # at most one unacknowledged message per slot.
+        self._slots = config.getint("amqp", "slots", 1)
+        self._prefetch_count = self._slots
+        self._free_slots = list(range(self._slots))
+        self._jobs = {}
+        self._basedir = os.getcwd()
+        self._selfdeploy_lock = threading.Lock()
+        self._resident = config.getboolean("amqp", "resident", False)
         self._routing_key = self.ROUTING_KEY_PREFIX + config.get(
             "amqp", "routing_key",
             os.getenv("RABBITMQ_ROUTING_KEY", self.ROUTING_KEY_REQUEST))
         self._queue = self.QUEUE + "_" + self._routing_key
         self._max_priority = config.getint("amqp", "max-priority", 1)
+        # With cache affinity, clients may route tasks to a private queue
+        # of the worker which holds most of their dependencies.
+        self._affinity = config.getboolean("amqp", "affinity", False)
+        self._affinity_timeout = config.getint("amqp", "affinity_timeout", 30)
+        self._affinity_consumer_tag = None
+        self._worker_id = "{}-{}".format(socket.gethostname(), os.getpid())
+        self._affinity_queue = self._queue + "_" + self._worker_id
 
     def connect(self):
         """This method connects to RabbitMQ, returning the connection handle.
@@ -305,17 +686,95 @@ class WorkerTaskConsumer(object):
 
         """
         log.info('Queue bound: {}', userdata)
+        if self._affinity:
+            self.setup_affinity_queue()
+        else:
+            self.set_qos()
+
+    def setup_affinity_queue(self):
+        """Setup the private queue of the worker. Clients publish tasks
+        to this queue when the worker has advertised that its cache holds
+        their dependencies. Tasks not consumed within the affinity timeout,
+        e.g. because the worker is busy or gone, are dead-lettered to the
+        shared queue.
+
+        """
+        log.info('Declaring queue {}', self._affinity_queue)
+        timeout = self._affinity_timeout * 1000
+        self._channel.queue_declare(
+            queue=self._affinity_queue,
+            callback=self.on_affinity_queue_declareok,
+            arguments={
+                "x-max-priority": self._max_priority,
+                "x-message-ttl": timeout,
+                "x-expires": 2 * timeout + 60000,
+                "x-dead-letter-exchange": self.EXCHANGE,
+                "x-dead-letter-routing-key": self._routing_key,
+            })
+
+    def on_affinity_queue_declareok(self, _unused_frame):
+        routing_key = self._routing_key + "@" + self._worker_id
+        log.info('Binding {} to {} with {}',
+                 self.EXCHANGE, self._affinity_queue, routing_key)
+        self._channel.queue_bind(
+            self._affinity_queue,
+            self.EXCHANGE,
+            routing_key=routing_key,
+            callback=self.on_affinity_bindok)
+
+    def on_affinity_bindok(self, _unused_frame):
+        log.info('Declaring exchange: {}', self.SUMMARY_EXCHANGE)
+        self._channel.exchange_declare(
+            exchange=self.SUMMARY_EXCHANGE,
+            exchange_type="fanout",
+            callback=self.on_summary_exchange_declareok)
+
+    def on_summary_exchange_declareok(self, _unused_frame):
         self.set_qos()
 
+    def publish_cache_summary(self):
+        """Advertise the artifacts present in the local cache to clients,
+        as a Bloom filter of artifact identities.
+
+        """
+        if not self._channel or self._closing:
+            return
+        identities = []
+        try:
+            identities = cache.ArtifactCache.get().get_identities()
+        except Exception:
+            log.exception()
+        bloom = utils.BloomFilter(len(identities))
+        for identity in identities:
+            bloom.add(identity)
+        self._channel.basic_publish(
+            exchange=self.SUMMARY_EXCHANGE,
+            routing_key="",
+            properties=pika.BasicProperties(expiration=str(SUMMARY_INTERVAL * 1000)),
+            body=json.dumps({
+                "worker": self._worker_id,
+                "routing_key": self._routing_key,
+                "cache": bloom.todict(),
+            }))
+
+    def schedule_cache_summary(self):
+        """Publish the cache summary periodically while consuming."""
+        if not self._consuming:
+            return
+        self.publish_cache_summary()
+        self._connection.ioloop.call_later(SUMMARY_INTERVAL, self.schedule_cache_summary)
+
     def set_qos(self):
-        """This method sets up the consumer prefetch to only be delivered
-        one message at a time. The consumer must acknowledge this message
-        before RabbitMQ will deliver another one. You should experiment
-        with different prefetch values to achieve desired performance.
+        """This method sets up the consumer prefetch to be delivered
+        one message at a time per configured slot. The consumer must
+        acknowledge a message before RabbitMQ will deliver another one
+        in its place.
 
         """
         self._channel.basic_qos(
-            prefetch_count=self._prefetch_count, callback=self.on_basic_qos_ok)
+            prefetch_count=self._prefetch_count,
+            global_qos=self._affinity,
+            callback=self.on_basic_qos_ok)
 
     def on_basic_qos_ok(self, _unused_frame):
         """Invoked by pika when the Basic.QoS method has completed. At this
@@ -342,8 +801,13 @@ class WorkerTaskConsumer(object):
         self.add_on_cancel_callback()
         self._consumer_tag = self._channel.basic_consume(
             self._queue, self.on_message)
+        if self._affinity:
+            self._affinity_consumer_tag = self._channel.basic_consume(
+                self._affinity_queue, self.on_message)
         self.was_consuming = True
         self._consuming = True
+        if self._affinity:
+            self.schedule_cache_summary()
 
     def add_on_cancel_callback(self):
         """Add a callback that will be invoked if RabbitMQ cancels the consumer
@@ -380,25 +844,49 @@ class WorkerTaskConsumer(object):
         :param bytes body: The message body
 
         """
-        log.info('Received execution request # {} from {}',
-                 basic_deliver.delivery_tag, properties.app_id)
+        if not self._free_slots:
+            # Jobs started on a lost channel may still occupy slots.
+            # The request is returned to the queue after a short delay
+            # to avoid redelivering it to this worker in a tight loop.
+            log.info('Received execution request # {} from {}, but all slots are busy',
+                     basic_deliver.delivery_tag, properties.app_id)
+            self._connection.ioloop.call_later(
+                POLL_INTERVAL, functools.partial(self.reject_message, channel, basic_deliver.delivery_tag))
+            return
+
+        slot = self._free_slots.pop(0)
+        log.info('Received execution request # {} from {} (slot {})',
+                 basic_deliver.delivery_tag, properties.app_id, slot)
 
         class Job(threading.Thread):
-            def __init__(self, consumer, channel, basic_deliver, properties, body):
+            def __init__(self, consumer, channel, basic_deliver, properties, body, slot):
                 super(Job, self).__init__()
                 self.consumer = consumer
                 self.channel = channel
                 self.basic_deliver = basic_deliver
                 self.properties = properties
                 self.body = body
+                self.slot = slot
+
+                headers = properties.headers or {}
+                self.request_format = headers.get(HEADER_FORMAT, FORMAT_XML)
+                self.response_format = select_format(headers.get(HEADER_ACCEPT))
+                self.stream = headers.get(HEADER_LOG) == "zlib"
+
+                # Jobs in different slots execute in separate workspaces
+                if consumer._slots > 1:
+                    self.workdir = fs.path.join(consumer._basedir, "slots", str(slot))
+                else:
+                    self.workdir = consumer._basedir
 
             def selfdeploy(self):
                 """ Installs the correct version of Jolt as specified in execution request. """
 
-                tools = Tools()
+                # Deployments are shared by all slots
+                tools = Tools(cwd=self.consumer._basedir)
                 manifest = JoltManifest()
                 try:
-                    manifest.parse()
+                    manifest.parse(fs.path.join(self.workdir, "default.joltxmanifest"))
                     ident = manifest.get_parameter("jolt_identity")
                     url = manifest.get_parameter("jolt_url")
                     if not ident or not url:
@@ -408,59 +896,131 @@ class WorkerTaskConsumer(object):
 
                     log.info("Jolt version: {}", ident)
 
-                    src = "build/selfdeploy/{}/src".format(ident)
-                    env = "build/selfdeploy/{}/env".format(ident)
-
-                    if not fs.path.exists(env):
-                        try:
-                            fs.makedirs(src)
-                            tools.run("curl {} | tar zx -C {}", url, src)
-                            tools.run("virtualenv {}", env)
-                            tools.run(". {}/bin/activate && pip install -e {}", env, src)
-                            if requires:
-                                tools.run(". {}/bin/activate && pip install {}", env, requires)
-                            if "autocompletion=" in tools.read_file(f"{src}/jolt/cli.py"):
-                                tools.run(". {}/bin/activate && pip install 'click<8.1'", env, src)
-                        except Exception as e:
-                            tools.rmtree("build/selfdeploy/{}", ident, ignore_errors=True)
-                            raise e
+                    src = tools.expand_path("build/selfdeploy/{}/src", ident)
+                    env = tools.expand_path("build/selfdeploy/{}/env", ident)
+                    lib = tools.expand_path("build/selfdeploy/{}/lib", ident)
+
+                    with self.consumer._selfdeploy_lock:
+                        if fs.path.exists(lib):
+                            venv = selfdeploy_venv(tools, src)
+                            return ". {}/bin/activate && PYTHONPATH={} python -m jolt".format(venv, lib)
+
+                        if not fs.path.exists(env):
+                            try:
+                                fs.makedirs(src)
+                                tools.run("curl {} | tar zx -C {}", url, src)
+
+                                jolt = install_wheelhouse(tools, src, lib)
+                                if jolt is not None:
+                                    return jolt
+
+                                tools.run("virtualenv {}", env)
+                                tools.run(". {}/bin/activate && pip install -e {}", env, src)
+                                if requires:
+                                    tools.run(". {}/bin/activate && pip install {}", env, requires)
+                                if "autocompletion=" in tools.read_file(f"{src}/jolt/cli.py"):
+                                    tools.run(". {}/bin/activate && pip install 'click<8.1'", env, src)
+                            except Exception as e:
+                                tools.rmtree("build/selfdeploy/{}", ident, ignore_errors=True)
+                                raise e
 
                     return ". {}/bin/activate && jolt".format(env)
                 except Exception as e:
                     log.exception()
                     raise e
 
+            def install_recipes(self, tools):
+                """ Installs the recipe bundle referenced by the request, if any. """
+                manifest = JoltManifest()
+                manifest.parse(fs.path.join(self.workdir, "default.joltxmanifest"))
+                if manifest.bundle:
+                    install_recipe_bundle(self.workdir, manifest.bundle)
+                    return
+
+                # Recipes are inlined in the request manifest
+                if fs.path.exists(fs.path.join(self.workdir, BUNDLE_MARKER)):
+                    tools.unlink(BUNDLE_MARKER)
+                for recipe in tools.glob("*.jolt"):
+                    tools.unlink(recipe)
+
+            def run_resident(self, resident, config_file):
+                """ Runs the build in a process forked from a resident worker. """
+                args = config_file.split() + ["-vv", "build", "--worker", "--result", "result.joltxmanifest"]
+                stdout = LogTail(fs.path.join(self.workdir, "stdout.log"), log.stdout)
+                stderr = LogTail(fs.path.join(self.workdir, "stderr.log"), log.stderr)
+                try:
+                    status = resident.build(self.workdir, args)
+                finally:
+                    stdout.stop()
+                    stderr.stop()
+
+                tools = Tools(cwd=self.workdir)
+                tools.unlink("stdout.log")
+                tools.unlink("stderr.log")
+
+                if status != 0:
+                    raise JoltCommandError(
+                        "Command failed: jolt build --worker", stdout.lines, stderr.lines, status)
+
+            @contextmanager
+            def stream_log(self):
+                """ Streams the log of the job to the client, if requested. """
+                if not self.stream:
+                    yield
+                    return
+                publish = functools.partial(self.consumer.add_on_log_callback, self)
+                with LogStream(publish) as stream, log.threadforward(stream.write, log.STDOUT):
+                    yield
+
             def run(self):
-                with open("default.joltxmanifest", "wb") as f:
-                    f.write(self.body)
+                fs.makedirs(self.workdir)
+                if self.request_format == FORMAT_XML:
+                    with open(fs.path.join(self.workdir, "default.joltxmanifest"), "wb") as f:
+                        f.write(self.body)
+                else:
+                    manifest = JoltManifest().decode(self.body, self.request_format)
+                    manifest.write(fs.path.join(self.workdir, "default.joltxmanifest"))
 
                 log.info("Manifest written")
 
-                tools = Tools()
-                for recipe in tools.glob("*.jolt"):
-                    tools.unlink(recipe)
+                tools = Tools(cwd=self.workdir)
+                result = fs.path.join(self.workdir, "result.joltxmanifest")
 
                 try:
-                    jolt = self.selfdeploy()
-                    config_file = config.get("amqp", "config", "")
-                    if config_file:
-                        config_file = "-c " + config_file
-
-                    log.info("Running jolt")
-                    tools.run("{} -vv {} build --worker --result result.joltxmanifest",
-                              jolt, config_file, output_stdio=True)
+                    with self.stream_log():
+                        self.install_recipes(tools)
+                        jolt = self.selfdeploy()
+                        config_file = config.get("amqp", "config", "")
+                        if config_file:
+                            config_file = "-c " + fs.path.join(self.consumer._basedir, config_file)
+
+                        resident = None
+                        if self.consumer._resident:
+                            resident = _get_resident_worker(jolt, config_file)
+
+                        log.info("Running jolt")
+                        if resident is not None:
+                            self.run_resident(resident, config_file)
+                        else:
+                            # Streamed output is captured through the log
+                            tools.run("{} -vv {} build --worker --result result.joltxmanifest",
+                                      jolt, config_file, output_stdio=not self.stream)
                 except JoltCommandError as e:
                     self.response = ""
                     try:
                         manifest = JoltManifest()
                         try:
-                            manifest.parse("result.joltxmanifest")
+                            manifest.parse(result)
                         except Exception:
                             manifest.duration = "0"
                         manifest.result = "FAILED"
-                        manifest.stdout = "\n".join(e.stdout)
-                        manifest.stderr = "\n".join(e.stderr)
-                        self.response = manifest.format()
+                        if self.stream:
+                            manifest.stdout = "\n".join(e.stdout[-LOG_TAIL:])
+                            manifest.stderr = "\n".join(e.stderr[-LOG_TAIL:])
+                        else:
+                            manifest.stdout = "\n".join(e.stdout)
+                            manifest.stderr = "\n".join(e.stderr)
+                        self.response = manifest.encode(self.response_format)
                     except Exception:
                         log.exception()
                     log.error("Task failed")
@@ -470,11 +1030,11 @@ class WorkerTaskConsumer(object):
                     try:
                         manifest = JoltManifest()
                         try:
-                            manifest.parse("result.joltxmanifest")
+                            manifest.parse(result)
                         except Exception:
                             manifest.duration = "0"
                         manifest.result = "FAILED"
-                        self.response = manifest.format()
+                        self.response = manifest.encode(self.response_format)
                     except Exception:
                         log.exception()
                     log.error("Task failed")
@@ -483,27 +1043,49 @@ class WorkerTaskConsumer(object):
                     try:
                         manifest = JoltManifest()
                         try:
-                            manifest.parse("result.joltxmanifest")
+                            manifest.parse(result)
                         except Exception:
                             manifest.duration = "0"
                         manifest.result = "SUCCESS"
-                        self.response = manifest.format()
+                        self.response = manifest.encode(self.response_format)
                     except Exception:
                         log.exception()
                     log.info("Task succeeded")
 
-                utils.call_and_catch(tools.unlink, "result.joltxmanifest")
+                utils.call_and_catch(tools.unlink, result)
                 self.consumer.add_on_job_completed_callback(self)
 
-        self._job = Job(self, channel, basic_deliver, properties, body)
-        self._job.start()
+        job = Job(self, channel, basic_deliver, properties, body, slot)
+        self._jobs[basic_deliver.delivery_tag] = job
+        job.start()
 
     def add_on_job_completed_callback(self, job):
         if self._connection:
             self._connection.ioloop.add_callback_threadsafe(
                 functools.partial(self.on_job_completed, job))
         else:
-            self._job = None
+            self._release_job(job)
+
+    def add_on_log_callback(self, job, data):
+        if self._connection:
+            utils.call_and_catch(
+                self._connection.ioloop.add_callback_threadsafe,
+                functools.partial(self.on_log, job, data))
+
+    def on_log(self, job, data):
+        if job.channel is self._channel:
+            self._channel.basic_publish(
+                exchange=self.RESULT_EXCHANGE,
+                routing_key=job.properties.correlation_id,
+                properties=pika.BasicProperties(
+                    correlation_id=job.properties.correlation_id,
+                    expiration="600000",
+                    headers={HEADER_LOG: "zlib"}),
+                body=data)
+
+    def _release_job(self, job):
+        if self._jobs.pop(job.basic_deliver.delivery_tag, None) is job:
+            self._free_slots.append(job.slot)
 
     def on_job_completed(self, job):
         job.join()
@@ -513,14 +1095,17 @@ class WorkerTaskConsumer(object):
                 routing_key=job.properties.correlation_id,
                 properties=pika.BasicProperties(
                     correlation_id=job.properties.correlation_id,
-                    expiration="600000"),
-                body=str(job.response))
+                    expiration="600000",
+                    headers={HEADER_FORMAT: job.response_format}),
+                body=job.response)
 
             self.acknowledge_message(job.basic_deliver.delivery_tag)
             log.info("Result published")
+            if self._affinity:
+                self.publish_cache_summary()
         else:
             log.info("Result not published as connection was lost")
-        self._job = None
+        self._release_job(job)
 
     def acknowledge_message(self, delivery_tag):
         """Acknowledge the message delivery from RabbitMQ by sending a
@@ -532,6 +1117,19 @@ class WorkerTaskConsumer(object):
         log.info('Acknowledging message {}', delivery_tag)
         self._channel.basic_ack(delivery_tag)
 
+    def reject_message(self, channel, delivery_tag):
+        """Return a message to the queue by sending a Basic.Nack RPC
+        method for the delivery tag. Nothing is sent if the channel
+        has been closed, in which case the message is requeued anyway.
+
+        :param pika.channel.Channel channel: The channel of the delivery
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+
+        """
+        if channel is self._channel and channel.is_open:
+            log.info('Requeueing message {}', delivery_tag)
+            channel.basic_nack(delivery_tag, requeue=True)
+
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
         Basic.Cancel RPC command.
@@ -539,6 +1137,8 @@ class WorkerTaskConsumer(object):
         """
         if self._channel:
             log.info('Sending a Basic.Cancel RPC command to RabbitMQ')
+            if self._affinity_consumer_tag:
+                self._channel.basic_cancel(self._affinity_consumer_tag)
             cb = functools.partial(
                 self.on_cancelok, userdata=self._consumer_tag)
             self._channel.basic_cancel(self._consumer_tag, cb)
@@ -595,8 +1195,8 @@ class WorkerTaskConsumer(object):
             else:
                 self._connection.ioloop.stop()
             log.info('Stopped')
-            if self._job:
-                self.on_job_completed(self._job)
+            for job in list(self._jobs.values()):
+                self.on_job_completed(job)
 
 
 class ReconnectingWorkerTaskConsumer(object):
@@ -647,44 +1247,337 @@ def amqp_worker(ctx):
     consumer.run()
 
 
+def _preload_recipes(workdir):
+    manifest = JoltManifest()
+    manifest.parse(fs.path.join(workdir, "default.joltxmanifest"))
+
+    recipes = [(recipe.path, recipe.source) for recipe in manifest.recipes]
+    if manifest.bundle:
+        tools = Tools(cwd=workdir)
+        recipes = [(recipe, tools.read_file(recipe)) for recipe in tools.glob("*.jolt")]
+
+    for path, source in recipes:
+        try:
+            loader.preload(fs.path.join(workdir, path), source)
+        except Exception as e:
+            log.verbose("Failed to preload {}: {}", path, e)
+
+
+def _run_resident_build(conn, workdir, args):
+    """ Runs a build in a process forked from the resident worker. Never returns. """
+    status = 1
+    try:
+        os.chdir(workdir)
+        jolt_cli.workdir = workdir
+        with open("stdout.log", "w") as stdout, open("stderr.log", "w") as stderr:
+            os.dup2(stdout.fileno(), sys.stdout.fileno())
+            os.dup2(stderr.fileno(), sys.stderr.fileno())
+        sys.argv = ["jolt"] + args
+        try:
+            jolt_main.main()
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else int(e.code is not None)
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        utils.call_and_catch(conn.send, status)
+        os._exit(status)
+
+
+def _reap_children():
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0] != 0:
+            pass
+    except ChildProcessError:
+        pass
+
+
+@cli.command(name="amqp-resident", hidden=True)
+@click.argument("address", type=str)
+@click.pass_context
+def amqp_resident(ctx, address):
+    """ Run a resident AMQP worker process """
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(address)
+    server.listen()
+    log.info("Resident worker started")
+
+    while True:
+        client, _ = server.accept()
+        conn = Connection(client.detach())
+        try:
+            workdir, args = conn.recv()
+        except EOFError:
+            conn.close()
+            continue
+
+        utils.call_and_catch(_preload_recipes, workdir)
+
+        if os.fork() == 0:
+            server.close()
+            _run_resident_build(conn, workdir, args)
+
+        conn.close()
+        _reap_children()
+
+
+@utils.Singleton
+class CacheAffinity(object):
+    """
+    Tracks the cache contents advertised by workers.
+
+    Summaries are received by the AmqpClient for as long as the client
+    is running. Tasks are routed to the worker whose cache holds the
+    largest number of dependency bytes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._summaries = {}
+
+    def on_summary(self, channel, basic_deliver, properties, body):
+        try:
+            summary = json.loads(body)
+            bloom = utils.BloomFilter.fromdict(summary["cache"])
+        except Exception:
+            return
+        with self._lock:
+            self._summaries[summary["worker"]] = (summary["routing_key"], bloom, time.time())
+
+    def select(self, tasks, routing_key):
+        """
+        Selects a worker for a set of tasks.
+
+        Returns the identifier of the worker consuming routing_key whose
+        cache holds the most dependency bytes, or None if no worker has any.
+        """
+        deps = set()
+        for task in tasks:
+            deps.update(child for child in task.children if child.has_artifact())
+        deps.difference_update(tasks)
+
+        best, best_score = None, 0
+        now = time.time()
+        with self._lock:
+            for worker, (key, bloom, timestamp) in list(self._summaries.items()):
+                if now - timestamp > 3 * SUMMARY_INTERVAL:
+                    del self._summaries[worker]
+                    continue
+                if key != routing_key:
+                    continue
+                score = sum(max(1, dep.artifact_size) for dep in deps if dep.identity in bloom)
+                if score > best_score:
+                    best, best_score = worker, score
+        return best
+
+
+@utils.Singleton
+class AmqpClient(object):
+    """
+    Connection to the AMQP service shared by all remote executions.
+
+    The connection is owned by a single I/O thread. Requests are published
+    by the I/O thread and results are received in a single reply queue,
+    from which they are dispatched to futures by correlation id.
+    If the connection is lost, it is reestablished transparently and
+    requests in progress continue waiting for results in the same queue.
+    Requests fail if the connection can't be reestablished within
+    ``amqp.reconnect_timeout`` seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connection = None
+        self._channel = None
+        # The broker doesn't allow clients to redeclare server-named
+        # queues, so the queue is named by the client.
+        self._reply_queue = "jolt-reply-" + uuid.uuid4().hex
+        self._reconnect_timeout = config.getint(NAME, "reconnect_timeout", 300)
+        self._outbox = []
+        self._pending = {}
+        self._logs = {}
+        self._affinity = config.getboolean(NAME, "affinity", False)
+        self._thread = threading.Thread(target=self._run, name="AmqpClient", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        lost = None
+        while True:
+            try:
+                self._connect()
+                lost = None
+                while True:
+                    self._connection.process_data_events(time_limit=None)
+            except Exception as e:
+                log.warning("[AMQP] Lost server connection: {}", e)
+                with self._lock:
+                    connection, self._connection = self._connection, None
+                if connection is not None:
+                    utils.call_and_catch(connection.close)
+                lost = lost or time.monotonic()
+                if time.monotonic() - lost > self._reconnect_timeout:
+                    self._fail_pending(JoltError("Lost connection to AMQP server"))
+                time.sleep(POLL_INTERVAL)
+
+    def _fail_pending(self, exc):
+        """ Fails all requests in progress. """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._outbox = []
+            self._logs = {}
+        for future in pending.values():
+            future.set_exception(exc)
+
+    def _connect(self):
+        connection = pika.BlockingConnection(parameters=pika.URLParameters(_get_url()))
+        self._channel = connection.channel()
+        self._channel.exchange_declare(
+            exchange=WorkerTaskConsumer.RESULT_EXCHANGE,
+            exchange_type=WorkerTaskConsumer.EXCHANGE_TYPE)
+        result = self._channel.queue_declare(
+            self._reply_queue, arguments={"x-expires": 7200000})
+        self._reply_queue = result.method.queue
+        with self._lock:
+            pending = list(self._pending.keys())
+        for corr_id in pending:
+            self._channel.queue_bind(
+                self._reply_queue,
+                WorkerTaskConsumer.RESULT_EXCHANGE,
+                routing_key=corr_id)
+        self._channel.basic_consume(
+            queue=self._reply_queue,
+            on_message_callback=self._on_response,
+            auto_ack=False)
+
+        if self._affinity:
+            self._channel.exchange_declare(
+                exchange=WorkerTaskConsumer.SUMMARY_EXCHANGE,
+                exchange_type="fanout")
+            queue = self._channel.queue_declare("", exclusive=True).method.queue
+            self._channel.queue_bind(queue, WorkerTaskConsumer.SUMMARY_EXCHANGE)
+            self._channel.basic_consume(
+                queue=queue,
+                on_message_callback=CacheAffinity.get().on_summary,
+                auto_ack=True)
+
+        log.debug("[AMQP] Established connection to server")
+        with self._lock:
+            self._connection = connection
+        self._flush()
+
+    def _flush(self):
+        """ Publishes queued requests. Runs in the I/O thread. """
+        while True:
+            with self._lock:
+                if not self._outbox:
+                    return
+                corr_id, body, routing_key, properties = self._outbox[0]
+            self._channel.queue_bind(
+                self._reply_queue,
+                WorkerTaskConsumer.RESULT_EXCHANGE,
+                routing_key=corr_id)
+            self._channel.basic_publish(
+                exchange=WorkerTaskConsumer.EXCHANGE,
+                routing_key=routing_key,
+                properties=properties,
+                body=body)
+            with self._lock:
+                self._outbox.pop(0)
+
+    def _on_response(self, channel, basic_deliver, properties, body):
+        channel.basic_ack(basic_deliver.delivery_tag)
+        headers = properties.headers or {}
+        if HEADER_LOG in headers:
+            with self._lock:
+                on_log = self._logs.get(properties.correlation_id)
+            if on_log is not None:
+                utils.call_and_catch(on_log, zlib.decompress(body).decode(errors="ignore").split("\n"))
+            return
+
+        with self._lock:
+            future = self._pending.pop(properties.correlation_id, None)
+            self._logs.pop(properties.correlation_id, None)
+        if future is not None:
+            channel.queue_unbind(
+                self._reply_queue,
+                WorkerTaskConsumer.RESULT_EXCHANGE,
+                routing_key=properties.correlation_id)
+            future.set_result((body, headers.get(HEADER_FORMAT, FORMAT_XML)))
+
+    def submit(self, corr_id, body, routing_key, priority=0, fmt=FORMAT_XML, on_log=None):
+        """
+        Publishes an execution request.
+
+        Returns a future which is resolved with the serialized result
+        manifest and its format. If on_log is given, the worker streams
+        the log of the execution and on_log is called with each batch
+        of received lines.
+        """
+        future = Future()
+        headers = {
+            "x-deduplication-header": corr_id,
+            HEADER_FORMAT: fmt,
+            HEADER_ACCEPT: ",".join(get_formats()),
+        }
+        if on_log is not None:
+            headers[HEADER_LOG] = "zlib"
+        properties = pika.BasicProperties(
+            correlation_id=corr_id,
+            priority=priority,
+            headers=headers)
+        with self._lock:
+            self._pending[corr_id] = future
+            if on_log is not None:
+                self._logs[corr_id] = on_log
+            self._outbox.append((corr_id, body, routing_key, properties))
+            connection = self._connection
+        if connection is not None:
+            utils.call_and_catch(connection.add_callback_threadsafe, self._flush)
+        return future
+
+
 class AmqpExecutor(scheduler.NetworkExecutor):
 
     def __init__(self, factory, task):
         super(AmqpExecutor, self).__init__(factory)
         self.factory = factory
-        self.callback_queue = None
-        self.connection = None
         self.priority = config.getint("amqp", "priority", 0)
         self.task = task
 
     def _create_manifest(self):
-        manifest = JoltManifest.export(self.task)
-        build = manifest.create_build()
-
-        tasks = [self.task.qualified_name]
-        tasks += [t.qualified_name for t in self.task.extensions]
-
-        for task in tasks:
-            mt = build.create_task()
-            mt.name = task
-
-        registry = scheduler.ExecutorRegistry.get()
-        for key, value in registry.get_network_parameters(self.task).items():
-            param = manifest.create_parameter()
-            param.key = key
-            param.value = value
+        manifest = self._create_request()
+        if self.factory.bundles:
+            for recipe in manifest.recipes:
+                manifest.remove_recipe(recipe)
+            manifest.bundle = self.factory.get_recipe_bundle()
 
         routing_key = WorkerTaskConsumer.ROUTING_KEY_PREFIX
         routing_key += getattr(self.task.task, "routing_key", WorkerTaskConsumer.ROUTING_KEY_REQUEST)
 
-        return manifest.format(), routing_key
+        if self.factory.affinity:
+            worker = CacheAffinity.get().select(self.task.batch or [self.task], routing_key)
+            if worker is not None:
+                log.debug("[AMQP] Routing {} to {}", self.task.short_qualified_name, worker)
+                routing_key += "@" + worker
+
+        return manifest.encode(self.factory.format), routing_key
+
+    def _on_log(self, lines):
+        self._streamed = True
+        for line in lines:
+            log.transfer(line, self.task.identity[:8])
 
     def _run(self, env):
         timeout = int(config.getint("amqp", "timeout", 300))
         manifest, routing_key = self._create_manifest()
 
-        self.connect()
-        self.publish_request(manifest, routing_key)
+        self._streamed = False
+        future = AmqpClient.get().submit(
+            self.task.identity, manifest, routing_key, self.priority, self.factory.format,
+            on_log=self._on_log if self.factory.stream else None)
 
         log.debug("[AMQP] Queued {0}", self.task.short_qualified_name)
 
@@ -692,142 +1585,65 @@ class AmqpExecutor(scheduler.NetworkExecutor):
         for extension in self.task.extensions:
             extension.running()
 
+        self.response = None
         while self.response is None:
             try:
-                self.connection.process_data_events(time_limit=timeout)
-                if self.response is None:
-                    self.task.info("Remote execution still in progress after {}",
-                                   self.task.duration_queued)
-            except (ConnectionError, AMQPConnectionError):
-                log.warning("[AMQP] Lost server connection")
-                self.connect()
+                self.response = future.result(timeout=timeout)
+            except TimeoutError:
+                self.task.info("Remote execution still in progress after {}",
+                               self.task.duration_queued)
 
         log.debug("[AMQP] Finished {0}", self.task.short_qualified_name)
 
         manifest = JoltManifest()
         with raise_task_error_on_exception(self.task, "failed to parse build result manifest"):
-            manifest.parsestring(self.response)
-
-        self.task.running(utils.duration() - float(manifest.duration))
-
-        if manifest.result != "SUCCESS":
-            output = []
-            if manifest.stdout:
-                output.extend(manifest.stdout.split("\n"))
-            if manifest.stderr:
-                output.extend(manifest.stderr.split("\n"))
-            for line in output:
-                log.transfer(line, self.task.identity[:8])
-            for task in [self.task] + self.task.extensions:
-                with task.task.report() as report:
-                    remote_report = manifest.find_task(task.qualified_name)
-                    if remote_report:
-                        for error in remote_report.errors:
-                            report.manifest.append(error)
-            raise_error("[AMQP] remote build failed with status: {0}".format(manifest.result))
-
-        raise_task_error_if(
-            self.task.has_artifact() and not env.cache.is_available_remotely(self.task), self.task,
-            "no task artifact available in any cache, check configuration")
-
-        raise_task_error_if(
-            self.task.has_artifact() and not env.cache.download(self.task) and env.cache.download_enabled(),
-            self.task, "failed to download task artifact")
-
-        for extension in self.task.extensions:
-            raise_task_error_if(
-                self.task.has_artifact() and not env.cache.download(extension) and env.cache.download_enabled(),
-                self.task, "failed to download task artifact")
-
-        return self.task
-
-    @utils.retried.on_exception((ConnectionError, AMQPConnectionError, AMQPConnectorStackTimeout))
-    def connect(self):
-        self.connection = pika.BlockingConnection(
-            parameters=pika.URLParameters(_get_url()))
-        self.channel = self.connection.channel()
-        if not self.callback_queue:
-            self.corr_id = self.task.identity
-            self.channel.exchange_declare(
-                exchange=WorkerTaskConsumer.RESULT_EXCHANGE,
-                exchange_type=WorkerTaskConsumer.EXCHANGE_TYPE)
-            result = self.channel.queue_declare(
-                '', arguments={"x-expires": 7200000})
-            self.callback_queue = result.method.queue
-            self.channel.queue_bind(
-                self.callback_queue,
-                WorkerTaskConsumer.RESULT_EXCHANGE,
-                routing_key=self.corr_id)
-        self.channel.basic_consume(
-            queue=self.callback_queue,
-            on_message_callback=self.on_response,
-            auto_ack=False)
-        log.debug("[AMQP] Established connection to server")
+            manifest.decode(*self.response)
 
-    def on_response(self, channel, basic_deliver, properties, body):
-        # log.debug("[AMQP] Completion of {}, expecting {}", properties.correlation_id, self.corr_id)
-        if self.corr_id == properties.correlation_id:
-            self.response = body.decode()
-            channel.basic_ack(basic_deliver.delivery_tag)
-        else:
-            channel.basic_ack(basic_deliver.delivery_tag)
-
-    def publish_request(self, manifest, routing_key):
-        props = pika.BasicProperties(
-            correlation_id=self.corr_id,
-            priority=self.priority,
-            headers={"x-deduplication-header": self.task.identity})
-        self.response = None
-        self.channel.basic_publish(
-            exchange=WorkerTaskConsumer.EXCHANGE,
-            routing_key=routing_key,
-            properties=props,
-            body=manifest)
+        output = []
+        # A streamed log has already shown the output
+        if manifest.stdout and not self._streamed:
+            output.extend(manifest.stdout.split("\n"))
+        if manifest.stderr and not self._streamed:
+            output.extend(manifest.stderr.split("\n"))
 
-    def run(self, env):
-        try:
-            self.task.started(TYPE)
-            hooks.task_started_execution(self.task)
-            for extension in self.task.extensions:
-                extension.started(TYPE)
-                hooks.task_started_execution(extension)
-            with hooks.task_run([self.task] + self.task.extensions):
-                self._run(env)
-            for extension in self.task.extensions:
-                hooks.task_finished_execution(extension)
-                extension.finished(TYPE)
-            hooks.task_finished_execution(self.task)
-            self.task.finished(TYPE)
-        except (ConnectionError, AMQPConnectionError):
-            log.exception()
-            for extension in self.task.extensions:
-                extension.failed(TYPE)
-            self.task.failed(TYPE)
-            raise_error("Lost connection to AMQP server")
-        except Exception as e:
-            log.exception()
-            for extension in self.task.extensions:
-                extension.failed(TYPE)
-            self.task.failed(TYPE)
-            raise e
-        finally:
-            if self.connection is not None:
-                utils.call_and_catch(self.connection.close)
+        self._merge_result(env, manifest, output)
         return self.task
 
 
 @scheduler.ExecutorFactory.Register
 class AmqpExecutorFactory(scheduler.NetworkExecutorFactory):
+    supports_batches = True
+
     def __init__(self, options):
         workers = config.getint(NAME, "workers", 16)
         super(AmqpExecutorFactory, self).__init__(max_workers=workers)
         self._options = options
+        self.affinity = config.getboolean(NAME, "affinity", False)
+        self.bundles = config.getboolean(NAME, "bundles", False)
+        self.stream = config.getboolean(NAME, "stream", True)
+        self.format = FORMAT_XML
+        # The request format is not negotiated. Compact requests
+        # must only be enabled once all workers support them.
+        if config.getboolean(NAME, "compact", False):
+            self.format = FORMAT_JSON_ZLIB
+        self._bundle = None
+        self._bundle_lock = threading.Lock()
 
     @property
     def options(self):
         return self._options
 
+    def get_recipe_bundle(self):
+        """ Returns the digest of the recipe bundle, publishing it on first use. """
+        with self._bundle_lock:
+            if self._bundle is None:
+                self._bundle = publish_recipe_bundle()
+            return self._bundle
+
     def create(self, task):
+        if self.affinity:
+            # Start receiving cache summaries
+            CacheAffinity.get()
         return AmqpExecutor(self, task)
 
 
@@ -1,3 +1,11 @@
+import contextlib
+import json
+import math
+import sqlite3
+import threading
+import time
+
+from jolt import cache
 from jolt import config
 from jolt import filesystem as fs
 from jolt import log
@@ -8,35 +16,214 @@ from jolt.hooks import TaskHook, TaskHookFactory
 log.verbose("[AutoWeight] Loaded")
 
 
+PHASE_DOWNLOAD = "download"
+PHASE_EXECUTION = "execution"
+PHASE_UPLOAD = "upload"
+
+
+class WeightDatabase(object):
+    """
+    Task duration history.
+
+    Samples are stored per qualified task name and phase in an SQLite
+    database in the cache directory. The database is shared by all Jolt
+    processes using the cache and uses write-ahead logging to allow
+    concurrent readers and writers.
+    """
+
+    def __init__(self, path, samples):
+        self._path = path
+        self._samples = samples
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @contextlib.contextmanager
+    def _db(self):
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self._path, timeout=60, check_same_thread=False)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._create_tables(self._conn)
+            yield self._conn
+
+    def _create_tables(self, db):
+        cur = db.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS samples "
+                    "(name text, task text, parameters text, phase text, duration real, timestamp real)")
+        cur.execute("CREATE INDEX IF NOT EXISTS samples_name ON samples (name, phase)")
+        cur.execute("CREATE INDEX IF NOT EXISTS samples_task ON samples (task, phase)")
+        cur.execute("CREATE TABLE IF NOT EXISTS resources "
+                    "(name text PRIMARY KEY, cpus integer, memory integer, size integer)")
+        db.commit()
+
+    def is_empty(self):
+        with self._db() as db:
+            cur = db.cursor()
+            cur.execute("SELECT COUNT(*) FROM samples")
+            return cur.fetchone()[0] == 0
+
+    def add_sample(self, name, task, parameters, phase, duration):
+        with self._db() as db:
+            cur = db.cursor()
+            parameters = json.dumps({key: str(value) for key, value in parameters.items()}, sort_keys=True)
+            cur.execute("INSERT INTO samples VALUES (?,?,?,?,?,?)",
+                        (name, task, parameters, phase, duration, time.time()))
+            cur.execute("DELETE FROM samples WHERE name = ? AND phase = ? AND rowid NOT IN "
+                        "(SELECT rowid FROM samples WHERE name = ? AND phase = ? ORDER BY rowid DESC LIMIT ?)",
+                        (name, phase, name, phase, self._samples))
+            db.commit()
+
+    def get_samples(self, name, phase):
+        with self._db() as db:
+            cur = db.cursor()
+            cur.execute("SELECT duration FROM samples WHERE name = ? AND phase = ?", (name, phase))
+            return [row[0] for row in cur.fetchall()]
+
+    def get_task_samples(self, task, phase):
+        """ Returns samples of all parameter combinations of a task, by parameters """
+        with self._db() as db:
+            cur = db.cursor()
+            cur.execute("SELECT parameters, duration FROM samples WHERE task = ? AND phase = ?", (task, phase))
+            samples = {}
+            for parameters, duration in cur.fetchall():
+                samples.setdefault(parameters, []).append(duration)
+            return samples
+
+    def get_resources(self, name):
+        with self._db() as db:
+            cur = db.cursor()
+            cur.execute("SELECT cpus, memory, size FROM resources WHERE name = ?", (name,))
+            row = cur.fetchone()
+            if row is None:
+                return {}
+            return {key: value for key, value in zip(["cpus", "memory", "size"], row) if value is not None}
+
+    def set_resources(self, name, **resources):
+        with self._db() as db:
+            cur = db.cursor()
+            cur.execute("INSERT OR IGNORE INTO resources (name) VALUES (?)", (name,))
+            for key, value in resources.items():
+                cur.execute("UPDATE resources SET {} = ? WHERE name = ?".format(key), (value, name))
+            db.commit()
+
+
+def percentile(samples, pct):
+    """ Returns the nearest-rank percentile of a list of samples """
+    samples = sorted(samples)
+    rank = max(1, int(math.ceil(pct / 100 * len(samples))))
+    return samples[min(rank, len(samples)) - 1]
+
+
 class WeightHooks(TaskHook):
     def __init__(self):
-        self._tasks = {}
         self._samples = config.getint("autoweight", "samples", 10)
-        self.load()
+        self._percentile = config.getint("autoweight", "percentile", 90)
+        self._db = WeightDatabase(self.dbpath, self._samples)
+        self._transfers = threading.local()
+        if self._db.is_empty():
+            self._import_legacy()
 
     @property
     def dbpath(self):
-        return fs.path.join(config.get_cachedir(), "autoweight.json")
+        return fs.path.join(config.get_cachedir(), "autoweight.db")
+
+    def _import_legacy(self):
+        """ Imports history from the JSON files used by earlier versions """
+        legacy_path = fs.path.join(config.get_cachedir(), "autoweight.json")
+        for name, durations in utils.fromjson(legacy_path, ignore_errors=True).items():
+            task, parameters = utils.parse_task_name(name)
+            for duration in durations:
+                self._db.add_sample(name, task, parameters, PHASE_EXECUTION, duration)
+
+        legacy_path = fs.path.join(config.get_cachedir(), "autoweight-resources.json")
+        for name, resources in utils.fromjson(legacy_path, ignore_errors=True).items():
+            resources = {key: resources[key] for key in ["cpus", "memory", "size"] if key in resources}
+            self._db.set_resources(name, **resources)
+
+    def _predict(self, task, phase):
+        """
+        Predicts the duration of a task phase.
+
+        Uses the configured percentile of the recorded samples of the
+        task. Tasks without history are estimated from the samples of
+        the most similar parameter combinations of the same task, i.e.
+        those sharing the most parameter values.
+        """
+        samples = self._db.get_samples(task.qualified_name, phase)
+        if samples:
+            return percentile(samples, self._percentile)
+
+        candidates = self._db.get_task_samples(task.name, phase)
+        if not candidates:
+            return None
+
+        parameters = task.task._get_parameters()
 
-    def load(self):
-        self._tasks = utils.fromjson(self.dbpath, ignore_errors=True)
+        def _similarity(other):
+            other = json.loads(other)
+            return sum(1 for key, value in parameters.items() if other.get(key) == str(value))
 
-    def save(self):
-        utils.tojson(self.dbpath, self._tasks, ignore_errors=True)
+        best = max(map(_similarity, candidates.keys()))
+        samples = []
+        for other, durations in candidates.items():
+            if _similarity(other) == best:
+                samples.extend(durations)
+        return percentile(samples, self._percentile)
+
+    def _record(self, task, phase, seconds):
+        self._db.add_sample(
+            task.qualified_name, task.name, task.task._get_parameters(),
+            phase, seconds)
 
     def task_created(self, task):
-        data = self._tasks.get(task.qualified_name)
-        if data:
-            task.weight = max(data)
+        weight = self._predict(task, PHASE_EXECUTION)
+        if weight is not None:
+            task.weight = weight
+        task.transfer_weight = self._predict(task, PHASE_DOWNLOAD)
+        task.upload_weight = self._predict(task, PHASE_UPLOAD)
+
+        # Estimates are only used for admission, see scheduler.ResourceQueue
+        resources = self._db.get_resources(task.qualified_name)
+        task.cpus_estimate = resources.get("cpus")
+        task.memory_estimate = resources.get("memory")
+        task.artifact_size = resources.get("size", 0)
+
+    def task_downloaded(self, task, seconds):
+        self._record(task, PHASE_DOWNLOAD, seconds)
+        self._transfers.seconds = getattr(self._transfers, "seconds", 0) + seconds
+
+    def task_uploaded(self, task, seconds):
+        self._record(task, PHASE_UPLOAD, seconds)
+        self._transfers.seconds = getattr(self._transfers, "seconds", 0) + seconds
+
+    def task_started_execution(self, task):
+        self._transfers.seconds = 0
+
+    def task_finished_execution(self, task):
+        # Requirements are downloaded and artifacts may be uploaded by
+        # the thread executing the task. Transfers are recorded separately.
+        if not task.duration_running:
+            return
+        seconds = task.duration_running.seconds - getattr(self._transfers, "seconds", 0)
+        self._record(task, PHASE_EXECUTION, max(0, seconds))
 
     def task_finished(self, task):
-        data = self._tasks.get(task.qualified_name)
-        if data:
-            data.append(task.duration_running.seconds)
-            self._tasks[task.qualified_name] = data[-self._samples:]
-        else:
-            self._tasks[task.qualified_name] = [task.duration_running.seconds]
-        self.save()
+        resources = {}
+        usage = task.tools._usage
+        if usage.cpus > 0:
+            resources.update({"cpus": usage.cpus, "memory": usage.memory})
+        size = self._artifact_size(task)
+        if size is not None:
+            resources["size"] = size
+        if resources:
+            self._db.set_resources(task.qualified_name, **resources)
+
+    def _artifact_size(self, task):
+        acache = cache.ArtifactCache.get()
+        if not task.is_cacheable() or not acache.is_available_locally(task):
+            return None
+        with acache.get_artifact(task) as artifact:
+            return artifact.get_size()
 
 
 @TaskHookFactory.register
@@ -1,6 +1,8 @@
+import fasteners
 import os
 import pygit2
 import re
+import threading
 
 from jolt.tasks import BooleanParameter, Export, Parameter, TaskRegistry, WorkspaceResource
 from jolt.influence import FileInfluence, HashInfluenceRegistry
@@ -19,8 +21,70 @@ from jolt.error import raise_task_error_if
 log.verbose("[Git] Loaded")
 
 
+# Workspace status flags of files that are added by 'git add -A'
+_STATUS_ADD = pygit2.GIT_STATUS_WT_NEW \
+    | pygit2.GIT_STATUS_WT_MODIFIED \
+    | pygit2.GIT_STATUS_WT_TYPECHANGE \
+    | pygit2.GIT_STATUS_CONFLICTED
+
+
+class GitMirror(object):
+    """
+    A host-wide bare mirror of a remote repository.
+
+    Mirrors are kept in the Jolt cache directory and are shared by all
+    workspaces on the host. Clones borrow objects from the mirror through
+    git alternates and only fetch what the mirror is missing. Updates are
+    serialized between threads and processes with a lock file.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.root = fs.path.join(config.get_cachedir(), "git", utils.sha1(url))
+        self.path = fs.path.join(self.root, "repo.git")
+        self.tools = Tools()
+        self._lock = threading.RLock()
+
+    def _lock_file(self):
+        return fasteners.InterProcessLock(fs.path.join(self.root, "lock"))
+
+    def update(self):
+        with self._lock:
+            fs.makedirs(self.root)
+            with self._lock_file():
+                if not fs.path.exists(fs.path.join(self.path, "HEAD")):
+                    log.info("Creating mirror of {0}", self.url)
+                    fs.rmtree(self.path, ignore_errors=True)
+                    self.tools.run("git clone --mirror {0} {1}", self.url, self.path,
+                                   output_on_error=True)
+                    # Clones depend on the objects in the mirror, never prune them
+                    self.tools.run("git --git-dir={0} config gc.auto 0", self.path,
+                                   output_on_error=True)
+                    self.tools.run("git --git-dir={0} config gc.pruneExpire never", self.path,
+                                   output_on_error=True)
+                else:
+                    log.info("Updating mirror of {0}", self.url)
+                    self.tools.run("git --git-dir={0} fetch --prune origin", self.path,
+                                   output_on_error=True)
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_mirror(url):
+    """ Returns the host-wide mirror of a repository, or None if mirroring is disabled. """
+    if not url or not config.getboolean("git", "mirror", False):
+        return None
+    with _mirrors_lock:
+        mirror = _mirrors.get(url)
+        if mirror is None:
+            mirror = _mirrors[url] = GitMirror(url)
+        return mirror
+
+
 class GitRepository(object):
-    def __init__(self, url, path, relpath, refspecs=None):
+    def __init__(self, url, path, relpath, refspecs=None, sparse=None):
         self.path = path
         self.relpath = relpath
         self.tools = Tools()
@@ -30,6 +94,8 @@ class GitRepository(object):
             '+refs/tags/*:refs/remotes/origin/*',
         ]
         self.refspecs = refspecs or []
+        self.sparse = sparse or []
+        self.mirror = get_mirror(url)
         self._tree_hash = {}
         self._original_head = True
         self._init_repo()
@@ -46,8 +112,8 @@ class GitRepository(object):
         return fs.path.join(self.path, ".git", "index")
 
     @utils.cached.instance
-    def _git_jolt_index(self):
-        return fs.path.join(self.path, ".git", "jolt-index")
+    def _git_jolt_tree_cache(self):
+        return fs.path.join(self.path, ".git", "jolt-tree.json")
 
     def is_cloned(self):
         return fs.path.exists(self._git_folder())
@@ -55,32 +121,85 @@ class GitRepository(object):
     def is_indexed(self):
         return fs.path.exists(self._git_index())
 
+    def _clone_args(self):
+        args = []
+        if self.mirror is not None:
+            self.mirror.update()
+            args.append("--reference " + self.mirror.path)
+        partial = config.get("git", "filter", "")
+        if partial:
+            args.append("--filter=" + partial)
+        if self.sparse:
+            args.append("--sparse")
+        return " ".join(args)
+
     def clone(self):
         log.info("Cloning into {0}", self.path)
+        args = self._clone_args()
         if fs.path.exists(self.path):
             with self.tools.cwd(self.path):
-                self.tools.run("git init && git remote add origin {} && git fetch",
-                               self.url, output_on_error=True)
+                self.tools.run("git init && git remote add origin {}", self.url, output_on_error=True)
+                if self.mirror is not None:
+                    alternates = fs.path.join(self._git_folder(), "objects", "info", "alternates")
+                    with open(alternates, "w") as f:
+                        f.write(fs.path.join(self.mirror.path, "objects") + "\n")
+                self.fetch(update_mirror=False)
         else:
-            self.tools.run("git clone {0} {1}", self.url, self.path, output_on_error=True)
+            self.tools.run("git clone {0} {1} {2}", args, self.url, self.path, output_on_error=True)
         raise_error_if(
             not fs.path.exists(self._git_folder()),
             "git: failed to clone repository '{0}'", self.relpath)
+        if self.sparse:
+            with self.tools.cwd(self.path):
+                self.tools.run("git sparse-checkout set {0}", " ".join(self.sparse),
+                               output_on_error=True)
         self._init_repo()
 
+    @utils.cached.instance
+    def _sparse_cone(self):
+        # Returns the directories of a cone mode sparse checkout as a tuple
+        # of (recursive, direct) directory sets, or None if the workspace is
+        # not sparse. Files outside the cone are not present in the workspace
+        # but must still be part of the workspace tree.
+        repository = pygit2.Repository(self.path)
+        try:
+            if not repository.config.get_bool("core.sparseCheckout"):
+                return None
+        except KeyError:
+            return None
+        try:
+            with open(fs.path.join(self._git_folder(), "info", "sparse-checkout")) as f:
+                patterns = [line.strip() for line in f.readlines()]
+        except OSError:
+            return None
+        direct = set([pattern.strip("/") for pattern in patterns
+                      if pattern.startswith("/") and pattern.endswith("/") and "*" not in pattern])
+        recursive = set([path for path in direct if "!/{}/*/".format(path) not in patterns])
+        return recursive, direct
+
+    def _is_sparse_excluded(self, path):
+        cone = self._sparse_cone()
+        if cone is None:
+            return False
+        recursive, direct = cone
+        dirname = fs.path.dirname(path)
+        if not dirname or dirname in direct:
+            return False
+        return not any(path.startswith(directory + "/") for directory in recursive)
+
     @utils.cached.instance
     def diff_unchecked(self):
         if not self.is_indexed():
             return ""
 
-        # Build the jolt index file
-        self.write_tree()
-
-        # Diff against the jolt index
-        with self.tools.environ(GIT_INDEX_FILE=self._git_jolt_index()), self.tools.cwd(self.path):
-            return self.tools.run("git diff --binary --no-ext-diff HEAD ./",
-                                  output_on_error=True,
-                                  output_rstrip=False)
+        # Diff HEAD against the tree of the workspace state
+        tree = self.repository.get(self.write_tree())
+        if self.repository.head_is_unborn:
+            diff = tree.diff_to_tree(swap=True, flags=pygit2.GIT_DIFF_SHOW_BINARY)
+        else:
+            head = self.repository.revparse_single("HEAD").peel(pygit2.Tree)
+            diff = head.diff_to_tree(tree, flags=pygit2.GIT_DIFF_SHOW_BINARY)
+        return diff.patch or ""
 
     def diff(self):
         diff = self.diff_unchecked()
@@ -132,15 +251,62 @@ class GitRepository(object):
             except Exception:
                 return str(commit)
 
+    def _tree_cache_key(self, repository, status):
+        # The key is made up of the index file and HEAD, which together
+        # describe the state of all clean files, and of the stat
+        # information of all dirty files.
+        index = os.stat(self._git_index())
+        key = [
+            "" if repository.head_is_unborn else str(repository.head.target),
+            index.st_mtime_ns,
+            index.st_size,
+        ]
+        for path, flags in sorted(status.items()):
+            try:
+                st = os.lstat(fs.path.join(self.path, path))
+                key.append((path, int(flags), st.st_mtime_ns, st.st_size, st.st_mode))
+            except OSError:
+                key.append((path, int(flags)))
+        return utils.sha1(str(key))
+
     @utils.cached.instance
     def write_tree(self):
-        tools = Tools()
-        with tools.cwd(self._git_folder()):
-            tools.copy("index", "jolt-index")
-        with tools.environ(GIT_INDEX_FILE=self._git_jolt_index()), tools.cwd(self.path):
-            tree = tools.run(
-                "git -c core.safecrlf=false add -A && git write-tree",
-                output_on_error=True)
+        """
+        Writes a tree object representing the current workspace state.
+
+        The equivalent of 'git add -A && git write-tree', but done in-process
+        with a private copy of the index. Only files reported as dirty by the
+        index stat cache are hashed. The resulting tree is cached between
+        runs, keyed by the index file and the stat information of dirty files.
+        """
+        repository = pygit2.Repository(self.path)
+        status = repository.status()
+
+        key = self._tree_cache_key(repository, status)
+        cache = utils.fromjson(self._git_jolt_tree_cache(), ignore_errors=True)
+        if cache.get("key") == key and cache.get("tree", "") in repository:
+            return cache["tree"]
+
+        # Changes are made to the in-memory index only, it is never written to disk.
+        index = repository.index
+        for path, flags in status.items():
+            if path.endswith("/"):
+                # Nested repository, not a regular file
+                continue
+            if flags & pygit2.GIT_STATUS_CONFLICTED:
+                with utils.ignore_exception():
+                    del index.conflicts[path]
+            if self._is_sparse_excluded(path):
+                continue
+            if flags & pygit2.GIT_STATUS_WT_DELETED or \
+               not fs.path.lexists(fs.path.join(self.path, path)):
+                with utils.ignore_exception():
+                    index.remove(path)
+            elif flags & _STATUS_ADD:
+                index.add(path)
+        tree = str(index.write_tree())
+
+        utils.tojson(self._git_jolt_tree_cache(), {"key": key, "tree": tree}, ignore_errors=True)
         return tree
 
     def tree_hash(self, sha=None, path="/"):
@@ -190,12 +356,20 @@ class GitRepository(object):
         with self.tools.cwd(self.path):
             return self.tools.run("git reset --hard", output_on_error=True)
 
-    def fetch(self):
+    def fetch(self, update_mirror=True):
         refspec = " ".join(self.default_refspecs + self.refspecs)
+        url = self.url
+        if self.mirror is not None:
+            # The mirror has all refs of the remote, fetch them locally
+            if update_mirror:
+                self.mirror.update()
+            url = self.mirror.path
+        partial = config.get("git", "filter", "")
         with self.tools.cwd(self.path):
             log.info("Fetching {0} from {1}", refspec or 'commits', self.url)
-            self.tools.run("git fetch {url} {refspec}",
-                           url=self.url,
+            self.tools.run("git fetch {filter} {url} {refspec}",
+                           filter="--filter=" + partial if partial and self.mirror is None else "",
+                           url=url,
                            refspec=refspec or '',
                            output_on_error=True)
 
@@ -213,16 +387,19 @@ class GitRepository(object):
 _gits = {}
 
 
-def new_git(url, path, relpath, refspecs=None):
+def new_git(url, path, relpath, refspecs=None, sparse=None):
     refspecs = utils.as_list(refspecs or [])
+    sparse = utils.as_list(sparse or [])
     try:
         git = _gits[path]
         raise_error_if(git.url != url, "multiple git repositories required at {}", relpath)
         raise_error_if(git.refspecs != refspecs,
                        "conflicting refspecs detected for git repository at  {}", relpath)
+        raise_error_if(git.sparse != sparse,
+                       "conflicting sparse paths detected for git repository at {}", relpath)
         return git
     except Exception:
-        git = _gits[path] = GitRepository(url, path, relpath, refspecs)
+        git = _gits[path] = GitRepository(url, path, relpath, refspecs, sparse)
         return git
 
 
@@ -310,7 +487,8 @@ class GitSrc(WorkspaceResource, FileInfluence):
         self.relpath = str(self.path) or self._get_name()
         self.abspath = fs.path.join(self.joltdir, self.relpath)
         self.refspecs = kwargs.get("refspecs", [])
-        self.git = new_git(self.url, self.abspath, self.relpath, self.refspecs)
+        self.sparse = kwargs.get("sparse", [])
+        self.git = new_git(self.url, self.abspath, self.relpath, self.refspecs, self.sparse)
 
     @utils.cached.instance
     def _get_name(self):
@@ -388,6 +566,12 @@ class Git(GitSrc):
         if not self._revision.is_imported:
             self.git.diff_unchecked()
         rev = self._get_revision()
+        if self.sparse:
+            # Only the paths in the sparse checkout influence consumers
+            return "{0}: {1}".format(
+                self.git.relpath,
+                ", ".join(["{0}: {1}".format(path, self.git.tree_hash(rev, path))
+                           for path in self.git.sparse]))
         if rev is not None:
             return self.git.tree_hash(rev)
         return "{0}: {1}".format(
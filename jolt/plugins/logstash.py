@@ -1,9 +1,19 @@
+import atexit
+import collections
 from contextlib import contextmanager
 from datetime import datetime
+import gzip
+import threading
+import time
+from requests.sessions import Session
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from jolt import config
-from jolt import filesystem as fs
 from jolt import log
+from jolt import trace
 from jolt.error import raise_error_if
 from jolt.hooks import TaskHook, TaskHookFactory
 
@@ -11,26 +21,133 @@ from jolt.hooks import TaskHook, TaskHookFactory
 log.verbose("[LogStash] Loaded")
 
 
+COMPRESSION_NONE = "none"
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+
+_SUFFIXES = {
+    COMPRESSION_NONE: "",
+    COMPRESSION_GZIP: ".gz",
+    COMPRESSION_ZSTD: ".zst",
+}
+
+
+_CONTENT_TYPES = {
+    COMPRESSION_NONE: "text/plain",
+    COMPRESSION_GZIP: "application/gzip",
+    COMPRESSION_ZSTD: "application/zstd",
+}
+
+
+def truncate(logbuffer, max_size):
+    """
+    Reads a log buffer, truncated to approximately max_size characters.
+
+    The beginning and the end of the log are kept and the middle is
+    replaced by a marker stating how much was removed.
+    """
+    if max_size <= 0:
+        return logbuffer.getvalue()
+    head, removed, tail = logbuffer.truncated(max_size)
+    if not removed:
+        return head + tail
+    return "{}\n\n[ ... {} characters truncated by logstash ... ]\n\n{}".format(head, removed, tail)
+
+
 class LogStashHooks(TaskHook):
     def __init__(self):
         self._uri = config.get("logstash", "http.uri")
         self._failed_enabled = config.getboolean("logstash", "failed", False)
         self._finished_enabled = config.getboolean("logstash", "finished", False)
+        self._compression = config.get("logstash", "compression", COMPRESSION_NONE)
+        self._max_size = config.getsize("logstash", "max_size", "16M")
         raise_error_if(not self._uri, "logstash.http.uri not configured")
+        raise_error_if(self._compression not in _SUFFIXES,
+                       "logstash.compression: unsupported algorithm '{}'", self._compression)
+        raise_error_if(self._compression == COMPRESSION_ZSTD and zstandard is None,
+                       "logstash.compression: zstd requires the zstandard Python package")
+
+        # Logs are compressed and uploaded in the background, see _run()
+        self._logs = collections.deque()
+        self._max_pending = config.getint("logstash", "max_pending", 10)
+        self._uploaded = 0
+        self._failed = 0
+        self._dropped = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._session = Session()
+        self._thread = threading.Thread(target=self._run, name="LogStash", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
 
     def _get_uri(self, task):
-        return "{}/{}-{}.txt".format(
+        return "{}/{}-{}.txt{}".format(
             self._uri,
             datetime.now().strftime("%Y-%m-%d_%H%M%S.%f"),
-            task.canonical_name)
+            task.canonical_name,
+            _SUFFIXES[self._compression])
+
+    def _compress(self, data):
+        if self._compression == COMPRESSION_GZIP:
+            return gzip.compress(data)
+        if self._compression == COMPRESSION_ZSTD:
+            return zstandard.ZstdCompressor().compress(data)
+        return data
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._logs and not self._closed:
+                    self._cond.wait()
+                if not self._logs:
+                    return
+                uri, logbuffer = self._logs.popleft()
+            self._upload(uri, logbuffer)
+
+    def _upload(self, uri, logbuffer):
+        try:
+            with trace.span("logstash", size=len(logbuffer)):
+                data = self._compress(logbuffer.encode(errors="replace"))
+                response = self._session.put(
+                    uri, data=data, headers={"Content-Type": _CONTENT_TYPES[self._compression]})
+            ok = response.status_code in [200, 201, 204]
+            if not ok:
+                log.verbose("[LogStash] Upload to '{}' failed with status '{}'", uri, response.status_code)
+        except Exception as e:
+            log.verbose("[LogStash] Upload to '{}' failed: {}", uri, e)
+            ok = False
+        with self._cond:
+            if ok:
+                self._uploaded += 1
+            else:
+                self._failed += 1
+
+    def close(self):
+        """ Uploads remaining logs and stops the upload thread. """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        start = time.monotonic()
+        self._thread.join()
+        if self._uploaded or self._failed or self._dropped:
+            log.debug("[LogStash] Uploaded {} logs, {} failed, {} dropped, {:.0f}ms spent at exit",
+                      self._uploaded, self._failed, self._dropped, 1000 * (time.monotonic() - start))
 
-    def _stash_log(self, task, logbuffer):
-        with task.tools.tmpdir("logstash") as t:
-            filepath = fs.path.join(t.path, "log")
-            with open(filepath, "w") as f:
-                f.write(logbuffer)
-            task.logstash = self._get_uri(task)
-            task.tools.upload(filepath, task.logstash, exceptions=False)
+    def _stash_log(self, task, logsink):
+        # The URI is assigned immediately to allow other
+        # plugins to reference the log before it is uploaded.
+        task.logstash = self._get_uri(task)
+        logbuffer = truncate(logsink, self._max_size)
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._logs) >= self._max_pending:
+                self._logs.popleft()
+                self._dropped += 1
+            self._logs.append((task.logstash, logbuffer))
+            self._cond.notify()
 
     @contextmanager
     def task_run(self, task):
@@ -39,11 +156,11 @@ class LogStashHooks(TaskHook):
                 yield
             except Exception as e:
                 if self._failed_enabled:
-                    self._stash_log(task, logsink.getvalue())
+                    self._stash_log(task, logsink)
                 raise e
             else:
                 if self._finished_enabled:
-                    self._stash_log(task, logsink.getvalue())
+                    self._stash_log(task, logsink)
 
 
 # Must run before other plugins which depend on the
@@ -0,0 +1,158 @@
+from contextlib import contextmanager
+import fasteners
+import os
+import queue
+import sys
+import threading
+
+from jolt import config
+from jolt import filesystem as fs
+from jolt import log
+from jolt import scheduler
+from jolt import utils
+from jolt.error import JoltCommandError
+from jolt.error import raise_error_if
+from jolt.error import raise_task_error_on_exception
+from jolt.manifest import JoltManifest
+from jolt.tools import Tools
+
+
+NAME = "multiprocess"
+
+_WORKER_CONFIG = """[jolt]
+cachedir = {cachedir}
+
+[volume]
+path = {volume}
+"""
+
+
+class Worker(object):
+    """
+    A local worker.
+
+    Each worker has a workspace and an artifact cache of its own and
+    executes one build request at a time. A new Jolt process is started
+    for each request.
+    Requests and results are exchanged as manifests, as with remote
+    workers. Artifacts are shared with the client and other workers
+    through the volume storage provider.
+    """
+
+    def __init__(self, path, volume):
+        self.path = path
+        self.tools = Tools(cwd=path)
+        self.config = fs.path.join(path, "worker.conf")
+        fs.makedirs(path)
+        self.tools.write_file(
+            self.config,
+            _WORKER_CONFIG.format(cachedir=fs.path.join(path, "cache"), volume=volume),
+            expand=False)
+
+    def build(self, manifest):
+        """
+        Executes a build request.
+
+        Returns the result manifest and, if the build failed, the
+        output of the worker process.
+        """
+        for recipe in self.tools.glob("*.jolt"):
+            self.tools.unlink(recipe)
+        self.tools.write_file("default.joltxmanifest", manifest.format(), expand=False)
+
+        result = fs.path.join(self.path, "result.joltxmanifest")
+        if fs.path.exists(result):
+            self.tools.unlink(result)
+
+        output = None
+        try:
+            self.tools.run("{} -m jolt -c {} -vv build --worker --result result.joltxmanifest",
+                           sys.executable, self.config, output=False)
+        except JoltCommandError as e:
+            output = e.stdout + e.stderr
+
+        manifest = JoltManifest()
+        try:
+            manifest.parse(result)
+        except Exception:
+            manifest.duration = "0"
+        manifest.result = "FAILED" if output is not None else "SUCCESS"
+        return manifest, output or []
+
+
+class MultiprocessExecutor(scheduler.NetworkExecutor):
+    def __init__(self, factory, task):
+        super(MultiprocessExecutor, self).__init__(factory)
+        self.factory = factory
+        self.task = task
+
+    def _run(self, env):
+        request = self._create_request()
+
+        with self.factory.get_worker() as worker:
+            log.debug("[MULTIPROCESS] Running {} in {}", self.task.short_qualified_name, worker.path)
+            self.task.running()
+            for extension in self.task.extensions:
+                extension.running()
+
+            with raise_task_error_on_exception(self.task, "failed to execute build request"):
+                manifest, output = worker.build(request)
+
+        self._merge_result(env, manifest, output)
+        return self.task
+
+
+@scheduler.ExecutorFactory.Register
+class MultiprocessExecutorFactory(scheduler.NetworkExecutorFactory):
+    supports_batches = True
+
+    def __init__(self, options):
+        workers = config.getint(NAME, "workers", os.cpu_count() or 1)
+        super(MultiprocessExecutorFactory, self).__init__(max_workers=workers)
+        self._options = options
+        self._path = config.get(NAME, "path", fs.path.join(config.get_cachedir(), NAME))
+        self._volume = config.get("volume", "path")
+        self._workers = queue.Queue()
+        self._count = 0
+        self._locks = []
+        self._lock = threading.Lock()
+
+    @property
+    def options(self):
+        return self._options
+
+    @contextmanager
+    def get_worker(self):
+        """ Reserves an idle worker, creating a new one if none is available. """
+        try:
+            worker = self._workers.get(block=False)
+        except queue.Empty:
+            raise_error_if(not self._volume, "[MULTIPROCESS] a volume storage provider must be configured")
+            worker = self._create_worker()
+        try:
+            yield worker
+        finally:
+            self._workers.put(worker)
+
+    def _create_worker(self):
+        # Workspaces are locked to keep concurrent clients apart
+        with self._lock:
+            while True:
+                path = fs.path.join(self._path, str(self._count))
+                self._count += 1
+                fs.makedirs(path)
+                lock = fasteners.InterProcessLock(fs.path.join(path, "lock"))
+                if lock.acquire(blocking=False):
+                    self._locks.append(lock)
+                    return Worker(path, self._volume)
+
+    def shutdown(self):
+        super(MultiprocessExecutorFactory, self).shutdown()
+        for lock in self._locks:
+            utils.call_and_catch(lock.release)
+
+    def create(self, task):
+        return MultiprocessExecutor(self, task)
+
+
+log.verbose("[MULTIPROCESS] Loaded")
@@ -13,6 +13,7 @@ from jolt import utils
 from jolt import filesystem as fs
 from jolt.error import raise_task_error_if
 from jolt.error import JoltError, JoltCommandError
+from jolt.tools import get_jobserver
 
 
 class CompileError(JoltError):
@@ -1725,7 +1726,11 @@ if __name__ == "__main__":
         self._write_ninja_cache(deps, tools)
         verbose = " -v" if log.is_verbose() else ""
         threads = config.get("jolt", "threads", tools.getenv("JOLT_THREADS", None))
-        threads = " -j" + threads if threads else ""
+        threads = " -j{}".format(tools.thread_count()) if threads or self.cpus else ""
+        # With a fifo jobserver, ninja draws job tokens from it.
+        # Ninja doesn't support pipe jobservers.
+        jobserver = get_jobserver()
+        threads = "" if jobserver is not None and jobserver.mode == "fifo" else threads
         depsfile = self._get_keepdepfile(tools)
         try:
             tools.run("ninja{3}{2} -C {0} {1}", self.outdir, verbose, threads, depsfile)
@@ -1,3 +1,5 @@
+import sys
+
 from jolt.tasks import Task, TaskRegistry
 from jolt.cache import ArtifactCache
 from jolt.graph import GraphBuilder
@@ -108,6 +110,27 @@ class Jolt(Task):
         del pkgs["jolt"]
         return pkgs.values()
 
+    @property
+    def wheelhouse(self):
+        return config.getboolean("selfdeploy", "wheelhouse", True)
+
+    def _build_wheelhouse(self, artifact, tools):
+        """
+        Builds wheels of Jolt and its pinned dependencies.
+
+        Workers install the wheels offline instead of resolving
+        and downloading dependencies from a package index. Requires
+        pinned requirements.
+        """
+        if not fs.path.exists(fs.path.join(artifact.path, "requirements.txt")):
+            log.verbose("[SelfDeploy] No pinned requirements, skipping wheelhouse")
+            return
+        with tools.cwd(tools.builddir("wheelhouse")):
+            tools.copy(artifact.path, "src")
+            tools.run("{} -m pip wheel -q --wheel-dir wheelhouse -r src/requirements.txt", sys.executable)
+            tools.run("{} -m pip wheel -q --no-deps --wheel-dir wheelhouse ./src", sys.executable)
+            artifact.collect("wheelhouse")
+
     def publish(self, artifact, tools):
         with tools.cwd(tools.builddir()):
             try:
@@ -131,6 +154,12 @@ class Jolt(Task):
             for e in self.extra_files:
                 with tools.cwd(fs.path.dirname(e)):
                     artifact.collect(fs.path.basename(e))
+        if self.wheelhouse:
+            try:
+                self._build_wheelhouse(artifact, tools)
+            except Exception:
+                log.exception()
+                log.warning("[SelfDeploy] Failed to build wheelhouse, workers will install from sources")
 
 
 class SelfDeployExtension(NetworkExecutorExtension):
@@ -1,9 +1,14 @@
+import atexit
+import collections
 from socket import gethostname
+import threading
+import time
 from requests.exceptions import RequestException
-from requests.api import post
+from requests.sessions import Session
 
 from jolt import config
 from jolt import log
+from jolt import trace
 from jolt import utils
 from jolt.error import raise_error_if
 from jolt.hooks import TaskHook, TaskHookFactory
@@ -32,7 +37,80 @@ class TelemetryHooks(TaskHook):
         self._finished = config.getboolean(plugin, "finished", finished)
         raise_error_if(not self._uri, "telemetry.uri not configured")
 
+        # Events are delivered in the background, see _run()
+        self._batch_size = config.getint(plugin, "batch_size", 1)
+        self._batch_interval = config.getint(plugin, "batch_interval", 100) / 1000
+        self._events = collections.deque()
+        self._max_events = config.getint(plugin, "max_events", 10000)
+        self._dropped = 0
+        self._delivered = 0
+        self._requests = 0
+        self._latency = 0.0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._session = Session()
+        self._thread = threading.Thread(target=self._run, name="Telemetry", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._events and not self._closed:
+                    self._cond.wait()
+                # Wait a while for more events to fill the batch
+                deadline = time.monotonic() + self._batch_interval
+                while len(self._events) < self._batch_size and not self._closed:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+                batch = self._pop_batch()
+            self._deliver(batch)
+
+    def _pop_batch(self):
+        return [self._events.popleft() for _ in range(min(self._batch_size, len(self._events)))]
+
     @utils.retried.on_exception((RequestException))
+    def _send(self, batch):
+        r = self._session.post(self._uri, json=batch if self._batch_size > 1 else batch[0])
+        r.raise_for_status()
+
+    def _deliver(self, batch):
+        if not batch:
+            return
+        start = time.monotonic()
+        try:
+            with trace.span("telemetry", events=len(batch)):
+                self._send(batch)
+        except Exception as e:
+            log.verbose("[Telemetry] Failed to deliver {} events: {}", len(batch), e)
+            with self._cond:
+                self._dropped += len(batch)
+            return
+        with self._cond:
+            self._delivered += len(batch)
+            self._requests += 1
+            self._latency += time.monotonic() - start
+
+    def close(self):
+        """ Stops the delivery thread and delivers remaining events. """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        while self._events:
+            self._deliver(self._pop_batch())
+        if self._requests:
+            log.debug("[Telemetry] Delivered {} events in {} requests, average latency {:.0f}ms, {} dropped",
+                      self._delivered, self._requests, 1000 * self._latency / self._requests, self._dropped)
+        elif self._dropped:
+            log.debug("[Telemetry] {} events dropped", self._dropped)
+
     def post(self, task, event, client):
         data = {
             "name": task.short_qualified_name,
@@ -45,8 +123,14 @@ class TelemetryHooks(TaskHook):
         if hasattr(task, "logstash"):
             data["log"] = task.logstash
 
-        r = post(self._uri, json=data)
-        r.raise_for_status()
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._events) >= self._max_events:
+                self._events.popleft()
+                self._dropped += 1
+            self._events.append(data)
+            self._cond.notify()
 
     def task_started(self, task):
         if task.is_remotely_executed():
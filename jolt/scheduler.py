@@ -1,16 +1,27 @@
 from concurrent.futures import ThreadPoolExecutor, as_completed, Future
+import functools
+import heapq
+import json
+import multiprocessing
 import os
+import pickle
+import psutil
 import queue
+import threading
 
 from jolt import config
 from jolt import hooks
 from jolt import log
 from jolt import utils
 from jolt import tools
+from jolt import trace
+from jolt.error import JoltCommandError
+from jolt.error import JoltError
 from jolt.error import raise_error
 from jolt.error import raise_task_error
 from jolt.error import raise_task_error_if
 from jolt.graph import PruneStrategy
+from jolt.manifest import JoltManifest
 from jolt.manifest import ManifestExtension
 from jolt.manifest import ManifestExtensionRegistry
 from jolt.options import JoltOptions
@@ -88,11 +99,19 @@ class Executor(object):
 
 
 class LocalExecutor(Executor):
-    def __init__(self, factory, task, force_upload=False, force_build=False):
+    def __init__(self, factory, task, force_upload=False, force_build=False, uploader=None):
         super(LocalExecutor, self).__init__(factory)
         self.task = task
         self.force_build = force_build
         self.force_upload = force_upload
+        self.uploader = uploader
+
+    def _run(self, env):
+        self.task.run(
+            env.cache,
+            force_build=self.force_build,
+            force_upload=self.force_upload,
+            uploader=functools.partial(self.uploader, env.cache) if self.uploader else None)
 
     def run(self, env):
         if self.is_aborted():
@@ -101,10 +120,7 @@ class LocalExecutor(Executor):
             self.task.started()
             hooks.task_started_execution(self.task)
             with hooks.task_run(self.task):
-                self.task.run(
-                    env.cache,
-                    force_build=self.force_build,
-                    force_upload=self.force_upload)
+                self._run(env)
         except Exception as e:
             log.exception()
             self.task.failed()
@@ -115,8 +131,210 @@ class LocalExecutor(Executor):
         return self.task
 
 
+class ProcessLocalExecutor(LocalExecutor):
+    """
+    Executes a task in a forked child process.
+
+    The child process shares the artifact cache with the parent through
+    the cache's interprocess locking. Log records, report errors and the
+    outcome of the task are sent back to the parent through a pipe.
+    """
+
+    def _run_child(self, env, conn):
+        lock = threading.Lock()
+
+        def send(kind, payload):
+            with lock:
+                conn.send((kind, payload))
+
+        log.forward(lambda record: send("log", record))
+
+        with self.task.task.report() as report:
+            count = len(report.manifest.errors)
+
+        # Exceptions are logged by the parent
+        error = None
+        try:
+            super(ProcessLocalExecutor, self)._run(env)
+        except BaseException as e:
+            error = e
+
+        with self.task.task.report() as report:
+            errors = [(e.type, e.location, e.message, e.details)
+                      for e in report.manifest.errors[count:]]
+
+        usage = self.task.tools._usage
+        send("result", (errors, self._serialize_error(error), (usage.cpus, usage.memory)))
+        conn.close()
+
+    @staticmethod
+    def _serialize_error(error):
+        if error is None:
+            return None
+        # The output of failed commands isn't pickled with the exception
+        if isinstance(error, JoltCommandError):
+            return ("command", (str(error), list(error.stdout), list(error.stderr), error.returncode))
+        try:
+            pickle.loads(pickle.dumps(error))
+        except Exception:
+            error = JoltError(str(error))
+        return ("exception", error)
+
+    @staticmethod
+    def _deserialize_error(error):
+        if error is None:
+            return None
+        kind, payload = error
+        if kind == "command":
+            return JoltCommandError(*payload)
+        return payload
+
+    def _run(self, env):
+        context = multiprocessing.get_context("fork")
+        reader, writer = context.Pipe(duplex=False)
+        process = context.Process(target=self._run_child, args=(env, writer))
+        process.start()
+        writer.close()
+
+        result = None
+        try:
+            while True:
+                try:
+                    kind, payload = reader.recv()
+                except EOFError:
+                    break
+                if kind == "log":
+                    log.replay(payload)
+                elif kind == "result":
+                    result = payload
+        finally:
+            reader.close()
+            process.join()
+
+        raise_task_error_if(
+            result is None, self.task,
+            "task process terminated unexpectedly (exit code {})", process.exitcode)
+
+        errors, error, usage = result
+        with self.task.task.report() as report:
+            for error_type, location, message, details in errors:
+                report.add_error(error_type, location, message, details)
+        self.task.tools._usage.update(*usage)
+        error = self._deserialize_error(error)
+        if error is not None:
+            raise error
+
+
 class NetworkExecutor(Executor):
-    pass
+    """
+    Base class of executors which send build requests to workers.
+
+    A request builds the task, or the last task of its batch. The other
+    members of the batch are built by the worker as its requirements.
+    Subclasses implement _run() to deliver the request created by
+    _create_request() and pass the result manifest to _merge_result().
+    """
+
+    execution_type = "Remote execution"
+
+    @property
+    def head(self):
+        """ The task built by the worker """
+        return self.task.batch[-1] if self.task.batch else self.task
+
+    def _create_request(self):
+        """ Exports a build request manifest for the task """
+        manifest = JoltManifest.export(self.head)
+        build = manifest.create_build()
+
+        tasks = [self.head.qualified_name]
+        tasks += [t.qualified_name for t in self.head.extensions]
+
+        for task in tasks:
+            mt = build.create_task()
+            mt.name = task
+
+        registry = ExecutorRegistry.get()
+        for key, value in registry.get_network_parameters(self.task).items():
+            param = manifest.create_parameter()
+            param.key = key
+            param.value = value
+
+        if trace.is_enabled():
+            param = manifest.create_parameter()
+            param.key = "jolt_trace"
+            param.value = "true"
+
+        unpublished = SubgraphPartitioner.unpublished(self.task.batch or [])
+        if unpublished:
+            # Tells the worker which requirements are only consumed within the batch
+            param = manifest.create_parameter()
+            param.key = "jolt_batch"
+            param.value = json.dumps([task.qualified_name for task in unpublished])
+
+        return manifest
+
+    def _merge_result(self, env, manifest, output=None):
+        """
+        Merges the result manifest of a build request.
+
+        Errors reported by the worker are added to the reports of the
+        tasks in the batch and the output of failed builds is logged.
+        The artifact of the task is downloaded if the build succeeded.
+        """
+        self.task.running(utils.duration() - float(manifest.duration or "0"))
+
+        if manifest.trace:
+            trace.merge(trace.loads(manifest.trace))
+
+        if manifest.result != "SUCCESS":
+            for line in output or []:
+                log.transfer(line, self.task.identity[:8])
+            for task in (self.task.batch or [self.task]) + self.head.extensions:
+                with task.task.report() as report:
+                    remote_report = manifest.find_task(task.qualified_name)
+                    if remote_report:
+                        for error in remote_report.errors:
+                            report.manifest.append(error)
+            raise_error("Remote build failed with status: {0}", manifest.result)
+
+        raise_task_error_if(
+            self.head.has_artifact() and not env.cache.is_available_remotely(self.head), self.head,
+            "no task artifact available in any cache, check configuration")
+
+        raise_task_error_if(
+            self.head.has_artifact() and not env.cache.download(self.head) and env.cache.download_enabled(),
+            self.head, "failed to download task artifact")
+
+        for extension in self.head.extensions:
+            raise_task_error_if(
+                self.head.has_artifact() and not env.cache.download(extension) and env.cache.download_enabled(),
+                self.head, "failed to download task artifact")
+
+    def _run(self, env):
+        raise NotImplementedError()
+
+    def run(self, env):
+        try:
+            self.task.started(self.execution_type)
+            hooks.task_started_execution(self.task)
+            for extension in self.task.extensions:
+                extension.started(self.execution_type)
+                hooks.task_started_execution(extension)
+            with hooks.task_run([self.task] + self.task.extensions):
+                self._run(env)
+            for extension in self.task.extensions:
+                hooks.task_finished_execution(extension)
+                extension.finished(self.execution_type)
+            hooks.task_finished_execution(self.task)
+            self.task.finished(self.execution_type)
+        except Exception as e:
+            log.exception()
+            for extension in self.task.extensions:
+                extension.failed(self.execution_type)
+            self.task.failed(self.execution_type)
+            raise e
+        return self.task
 
 
 class SkipTask(Executor):
@@ -204,28 +422,39 @@ class ExecutorRegistry(object):
         self._factories = [factory(self._options) for factory in self.__class__.executor_factories]
         self._local_factory = LocalExecutorFactory(self._options)
         self._concurrent_factory = ConcurrentLocalExecutorFactory(self._options)
+        self._transfer_factory = TransferExecutorFactory(self._options)
         self._extensions = [factory().create() for factory in self.__class__.extension_factories]
+        self._uploads = []
+        self._uploads_lock = threading.Lock()
 
     def shutdown(self):
         for factory in self._factories:
             factory.shutdown()
         self._local_factory.shutdown()
         self._concurrent_factory.shutdown()
+        self._transfer_factory.shutdown()
 
     def create_skipper(self, task):
         return SkipTask(self._concurrent_factory, task)
 
     def create_downloader(self, task):
-        # TODO: Switch to concurrent factory once the progress bar can handle it
-        return Downloader(self._concurrent_factory, task)
+        return Downloader(self._transfer_factory, task)
 
     def create_uploader(self, task):
-        # TODO: Switch to concurrent factory once the progress bar can handle it
-        return Uploader(self._concurrent_factory, task)
+        return Uploader(self._transfer_factory, task)
+
+    def create_local(self, task, force=False, async_upload=False):
+        """
+        Creates an executor that runs the task in the local process.
 
-    def create_local(self, task, force=False):
+        If async_upload is True, the task artifact is uploaded in the
+        background by the transfer pool once it has been committed to
+        the local cache, allowing dependent tasks to start early.
+        Use wait_for_uploads() to wait for the uploads to complete.
+        """
         task.set_locally_executed()
-        return self._local_factory.create(task, force=force)
+        uploader = self.upload_async if async_upload and self._transfer_factory.async_upload else None
+        return self._local_factory.create(task, force=force, uploader=uploader)
 
     def create_network(self, task):
         for factory in self._factories:
@@ -235,6 +464,47 @@ class ExecutorRegistry(object):
                 return executor
         return self.create_local(task)
 
+    def supports_batches(self):
+        """ Returns True if all network executors can execute task batches """
+        return bool(self._factories) and all(factory.supports_batches for factory in self._factories)
+
+    def get_parallelism(self, network=False):
+        """ Returns the number of tasks that may execute in parallel """
+        if network and self._factories:
+            return sum(factory.max_workers for factory in self._factories)
+        return self._local_factory.max_workers
+
+    def upload_async(self, cache, task, lock, force=False):
+        future = cache.upload_async(task, self._transfer_factory.pool, lock, force=force)
+        with self._uploads_lock:
+            self._uploads.append((task, future))
+        return future
+
+    def wait_for_uploads(self):
+        """
+        Waits for all background artifact uploads to complete.
+
+        Raises an error if any of the uploads failed.
+        """
+        with self._uploads_lock:
+            uploads, self._uploads = self._uploads, []
+        if not all(future.done() for _, future in uploads):
+            log.info("Waiting for artifact uploads to complete")
+
+        errors = []
+        for task, future in uploads:
+            try:
+                raise_task_error_if(
+                    not future.result(), task,
+                    "failed to upload task artifact")
+            except Exception as e:
+                log.exception()
+                with task.task.report() as report:
+                    report.add_exception(e)
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
     def get_network_parameters(self, task):
         parameters = {}
         for extension in self._extensions:
@@ -263,6 +533,8 @@ class Job(object):
         self.future = future
         self.executor = executor
         self.env = env
+        self.resources = (0, 0)
+        self.queued = trace.now()
 
     def __le__(self, o):
         return self.priority <= o.priority
@@ -287,7 +559,10 @@ class ExecutorFactory(object):
         return cls
 
     def __init__(self, options=None, max_workers=None):
-        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix=self.__class__.__name__)
+        self.max_workers = self.pool._max_workers
         self._aborted = False
         self._queue = queue.PriorityQueue()
         self._options = options or JoltOptions()
@@ -308,9 +583,16 @@ class ExecutorFactory(object):
     def _run(self):
         job = self._queue.get(False)
         self._queue.task_done()
+        self._run_job(job)
+
+    def _run_job(self, job):
+        task = job.executor.task
+        trace.complete("queued", job.queued, task=task)
         try:
             if not self.is_aborted():
-                job.executor.run(job.env)
+                with trace.span(task.short_qualified_name, "task", task=task,
+                                executor=job.executor.__class__.__name__):
+                    job.executor.run(job.env)
         except KeyboardInterrupt as e:
             raise_error("Interrupted by user")
             self._aborted = True
@@ -329,6 +611,71 @@ class ExecutorFactory(object):
         return future
 
 
+class ResourceQueue(object):
+    """
+    Priority queue of jobs that admits jobs based on resource tokens.
+
+    Tasks may declare a demand for CPUs and memory. A job is only
+    returned by get() once there are enough free tokens to satisfy
+    the demand of its task. Demands are capped to the total number of
+    tokens so that every task can eventually be admitted. Tasks without
+    demands are admitted immediately.
+    """
+
+    def __init__(self, cpus, memory):
+        self.cpus = cpus
+        self.memory = memory
+        self._cpus_free = cpus
+        self._memory_free = memory
+        self._jobs = []
+        self._cond = threading.Condition()
+
+    def _demand(self, job):
+        # Declared demands take precedence over estimates
+        proxy = job.executor.task
+        task = proxy.task
+        cpus = min(int(task.cpus or proxy.cpus_estimate or 0), self.cpus)
+        memory = min(utils.parse_size(task.memory or proxy.memory_estimate or 0), self.memory)
+        return cpus, memory
+
+    def _select(self):
+        # Task weights may change while jobs are queued
+        for job in sorted(self._jobs, key=lambda job: -job.executor.task.weight):
+            cpus, memory = self._demand(job)
+            if cpus <= self._cpus_free and memory <= self._memory_free:
+                return job, cpus, memory
+        return None, 0, 0
+
+    def put(self, job):
+        with self._cond:
+            self._jobs.append(job)
+            self._cond.notify_all()
+
+    def get(self):
+        with self._cond:
+            job, cpus, memory = self._select()
+            while job is None:
+                self._cond.wait()
+                job, cpus, memory = self._select()
+            self._jobs = [other for other in self._jobs if other is not job]
+            self._cpus_free -= cpus
+            self._memory_free -= memory
+            job.resources = (cpus, memory)
+
+        # Tools.thread_count() returns the granted number of CPUs.
+        # Estimated demands never limit the number of threads.
+        if cpus and job.executor.task.task.cpus:
+            job.executor.task.task.cpus = cpus
+        return job
+
+    def release(self, job):
+        cpus, memory = job.resources
+        with self._cond:
+            self._cpus_free += cpus
+            self._memory_free += memory
+            self._cond.notify_all()
+
+
 class LocalExecutorFactory(ExecutorFactory):
     def __init__(self, options=None):
         max_workers = config.getint(
@@ -337,9 +684,29 @@ class LocalExecutorFactory(ExecutorFactory):
         super(LocalExecutorFactory, self).__init__(
             options=options,
             max_workers=max_workers)
+        self._queue = ResourceQueue(
+            cpus=config.getint("jolt", "cpus", tools.Tools().cpu_count()),
+            memory=config.getsize("jolt", "memory", psutil.virtual_memory().total))
 
-    def create(self, task, force=False):
-        return LocalExecutor(self, task, force_build=force)
+    def _run(self):
+        job = self._queue.get()
+        try:
+            self._run_job(job)
+        finally:
+            self._queue.release(job)
+
+    def create(self, task, force=False, uploader=None):
+        if task.task.isolation == "process":
+            if task.has_extensions():
+                log.debug("Process isolation not supported for tasks with extensions: {}",
+                          task.short_qualified_name)
+            elif "fork" not in multiprocessing.get_all_start_methods():
+                log.debug("Process isolation not supported on this platform: {}",
+                          task.short_qualified_name)
+            else:
+                # The artifact is uploaded by the child process before it exits
+                return ProcessLocalExecutor(self, task, force_build=force)
+        return LocalExecutor(self, task, force_build=force, uploader=uploader)
 
 
 class ConcurrentLocalExecutorFactory(ExecutorFactory):
@@ -353,7 +720,30 @@ class ConcurrentLocalExecutorFactory(ExecutorFactory):
         raise NotImplementedError()
 
 
+class TransferExecutorFactory(ExecutorFactory):
+    """
+    Bounded pool for artifact downloads and uploads.
+
+    Network transfers are kept apart from the pool executing tasks so
+    that a slow transfer never occupies a compute slot.
+    """
+
+    def __init__(self, options=None):
+        max_workers = config.getint(
+            "jolt", "parallel_transfers", tools.Tools().thread_count())
+        super(TransferExecutorFactory, self).__init__(
+            options=options,
+            max_workers=max_workers)
+        self.async_upload = config.getboolean("jolt", "async_upload", True)
+
+    def create(self, task):
+        raise NotImplementedError()
+
+
 class NetworkExecutorFactory(ExecutorFactory):
+    # Whether executors run all tasks in TaskProxy.batch, see SubgraphPartitioner
+    supports_batches = False
+
     def __init__(self, *args, **kwargs):
         super(NetworkExecutorFactory, self).__init__(*args, **kwargs)
 
@@ -377,7 +767,7 @@ class LocalStrategy(ExecutionStrategy, PruneStrategy):
             return self.executors.create_skipper(task)
         if self.cache.download_enabled() and task.is_available_remotely(self.cache):
             return self.executors.create_downloader(task)
-        return self.executors.create_local(task)
+        return self.executors.create_local(task, async_upload=True)
 
     def should_prune_requirements(self, task):
         if task.is_alias() or not task.is_cacheable():
@@ -411,15 +801,121 @@ class DownloadStrategy(ExecutionStrategy, PruneStrategy):
         return False
 
 
+class SubgraphPartitioner(object):
+    """
+    Groups chains of tasks into batches executed by a single network request.
+
+    A batch starts with a task that is ready to be executed and grows
+    towards its dependents for as long as:
+
+     - the last task in the batch has exactly one dependent and isn't a goal,
+       i.e. its artifact is only consumed within the batch,
+     - all other requirements of the dependent are already completed,
+     - the dependent is executed with the same network parameters,
+     - the predicted execution time of the batch doesn't exceed the
+       configured limit plus the predicted time saved by not downloading
+       the artifacts consumed within the batch and by not uploading the
+       artifacts of unpublished members.
+
+    The batch is executed by the network executor of its first task.
+    The other tasks are skipped once the batch has finished. Artifacts
+    consumed within the batch are not published to the remote cache if
+    they are unpublished members, see unpublished().
+    """
+
+    def __init__(self, executors, cost):
+        self.executors = executors
+        self.cost = cost
+        self.bandwidth = config.getsize("jolt", "bandwidth", 10 * 1024 ** 2)
+
+    @staticmethod
+    def unpublished(batch):
+        """
+        Returns the members of a batch whose artifacts need not be published.
+
+        Requirements of a self-sustained task are pruned once its artifact
+        is available, so artifacts consumed only by a self-sustained member
+        of the batch are never needed again. Other artifacts are transitive
+        requirements of the last task in the batch and must be published.
+        """
+        for index in reversed(range(len(batch))):
+            if batch[index].task.selfsustained:
+                return batch[:index]
+        return []
+
+    def _is_batchable(self, task, cache):
+        return task.batch is None and \
+            not task.in_progress() and \
+            not task.is_alias() and \
+            not task.is_resource() and \
+            not task.extensions and \
+            task.is_cacheable() and \
+            not task.is_available_remotely(cache)
+
+    def _network_parameters(self, task):
+        return (getattr(task.task, "routing_key", None),
+                self.executors.get_network_parameters(task))
+
+    def partition(self, task, cache):
+        """ Assigns a batch to a task and its dependents, returns the batch """
+        if not self._is_batchable(task, cache):
+            return [task]
+
+        batch = [task]
+        cost = task.execution_weight
+        saved = 0
+        published = 0
+        parameters = self._network_parameters(task)
+
+        while not batch[-1].is_goal():
+            dependents = list(task.graph.predecessors(batch[-1]))
+            if len(dependents) != 1:
+                break
+            dependent = dependents[0]
+            if not self._is_batchable(dependent, cache):
+                break
+            if any(child not in batch for child in task.graph.successors(dependent)):
+                break
+            if self._network_parameters(dependent) != parameters:
+                break
+            transfer = predict_download(batch[-1], self.bandwidth)
+            if dependent.task.selfsustained:
+                # All preceding members become unpublished
+                transfer += sum(predict_upload(member, self.bandwidth) for member in batch[published:])
+            if cost + dependent.execution_weight > self.cost + saved + transfer:
+                break
+            cost += dependent.execution_weight
+            saved += transfer
+            batch.append(dependent)
+            if dependent.task.selfsustained:
+                published = len(batch) - 1
+
+        if len(batch) > 1:
+            log.debug("Batched: {}", ", ".join(member.short_qualified_name for member in batch))
+            for member in batch:
+                member.batch = batch
+                if not member.is_goal(with_extensions=False):
+                    member.disable_download()
+        return batch
+
+
 class DistributedStrategy(ExecutionStrategy, PruneStrategy):
     def __init__(self, executors, cache):
         self.executors = executors
         self.cache = cache
+        self.partitioner = None
+        batch_cost = config.getint("network", "batch_cost", 0)
+        if batch_cost > 0 and executors.supports_batches():
+            self.partitioner = SubgraphPartitioner(executors, batch_cost)
 
     def create_executor(self, task):
         if task.is_alias():
             return self.executors.create_skipper(task)
 
+        if task.batch is not None and task is not task.batch[0]:
+            # Executed by the network request of the first task in the batch
+            return self.executors.create_skipper(task)
+
         if task.is_resource():
             if task.deps_available_locally(self.cache):
                 return self.executors.create_local(task)
@@ -450,6 +946,9 @@ class DistributedStrategy(ExecutionStrategy, PruneStrategy):
             if task.is_fast() and task.deps_available_locally(self.cache):
                 return self.executors.create_local(task)
 
+        if self.partitioner is not None:
+            self.partitioner.partition(task, self.cache)
+
         return self.executors.create_network(task)
 
     def should_prune_requirements(self, task):
@@ -461,9 +960,11 @@ class DistributedStrategy(ExecutionStrategy, PruneStrategy):
 
 
 class WorkerStrategy(ExecutionStrategy, PruneStrategy):
-    def __init__(self, executors, cache):
+    def __init__(self, executors, cache, batch=None):
         self.executors = executors
         self.cache = cache
+        # Qualified names of the unpublished members of a requested batch
+        self.batch = set(batch or [])
 
     def create_executor(self, task):
         if task.is_resource():
@@ -487,16 +988,25 @@ class WorkerStrategy(ExecutionStrategy, PruneStrategy):
                 if task.is_unpacked(self.cache) and task.is_uploadable(self.cache):
                     return self.executors.create_uploader(task)
                 else:
-                    return self.executors.create_local(task, force=True)
+                    return self.executors.create_local(task, force=True, async_upload=True)
             return self.executors.create_skipper(task)
 
         if not self.cache.download_enabled():
-            return self.executors.create_local(task)
+            return self._create_local(task)
 
         if task.is_available_remotely(self.cache):
             return self.executors.create_downloader(task)
 
-        return self.executors.create_local(task)
+        return self._create_local(task)
+
+    def _create_local(self, task):
+        # Unpublished members of a requested batch are only consumed
+        # within the batch, see SubgraphPartitioner.unpublished().
+        if not task.is_goal() and task.qualified_name in self.batch:
+            task.disable_upload()
+            for extension in task.extensions:
+                extension.disable_upload()
+        return self.executors.create_local(task, async_upload=True)
 
     def should_prune_requirements(self, task):
         if task.is_alias() or not task.is_cacheable():
@@ -512,6 +1022,211 @@ class WorkerStrategy(ExecutionStrategy, PruneStrategy):
         return False
 
 
+def predict_download(node, bandwidth):
+    """ Returns the predicted download time of a task artifact """
+    if node.transfer_weight is not None:
+        return node.transfer_weight
+    return node.artifact_size / bandwidth
+
+
+def predict_upload(node, bandwidth):
+    """ Returns the predicted upload time of a task artifact """
+    if node.upload_weight is not None:
+        return node.upload_weight
+    return node.artifact_size / bandwidth
+
+
+class CriticalPath(object):
+    """
+    Prioritizes tasks along the critical path of the build.
+
+    The priority of a task is its upward rank, as used by the HEFT
+    list scheduling heuristic: the predicted time from the start of the
+    task until the last of its dependents has finished. The predicted
+    cost of a task is:
+
+     - zero, if the artifact is already present in the local cache,
+     - the expected download time, if the artifact will be downloaded,
+     - the historical execution time, i.e. the task weight, otherwise.
+
+    Download and upload times are predicted from previous transfers of
+    the artifact or from its size and the configured bandwidth. In distributed builds,
+    the artifacts of tasks executed remotely must also be transferred to
+    the host executing their dependents.
+
+    Ranks are recomputed incrementally as tasks finish. Measured durations
+    of finished tasks replace the predictions of tasks without history
+    that are instances of the same task class, and the ranks of their
+    requirements are updated accordingly. The rank is assigned to the
+    task weight which orders ready tasks and queued local jobs.
+    """
+
+    def __init__(self, dag, cache, network=False, parallelism=1):
+        self.dag = dag
+        self.cache = cache
+        self.network = network
+        self.parallelism = max(1, parallelism)
+        self.bandwidth = config.getsize("jolt", "bandwidth", 10 * 1024 ** 2)
+        self._duration = utils.duration()
+        self._nodes = dag.topological_nodes
+        self._order = {node: index for index, node in enumerate(self._nodes)}
+        self._instances = {}
+        for node in self._nodes:
+            self._instances.setdefault(node.canonical_name, {})[node] = True
+        self._parents = {node: list(dag.predecessors(node)) for node in self._nodes}
+        self._children = {node: list(dag.successors(node)) for node in self._nodes}
+        self._cost = {}
+        self._rank = {}
+        self._actual = {}
+        self._measured = {}
+        self._executed = set()
+        self._calibrated = set()
+
+        # Remote availability is usually known from when the graph was
+        # pruned. The remaining nodes are checked concurrently.
+        utils.map_concurrent(
+            lambda node: node.is_available_remotely(self.cache),
+            [node for node in self._nodes if self._needs_remote_check(node)])
+
+        for node in self._nodes:
+            self._cost[node] = self._predict_cost(node)
+        self._update(self._nodes)
+
+        self.critical_path = max(self._rank.values(), default=0)
+        self.work = sum(self._cost.values())
+        self.makespan = max(self.critical_path, self.work / self.parallelism)
+        log.verbose("Predicted makespan: {:.1f}s (critical path {:.1f}s)",
+                    self.makespan, self.critical_path)
+
+    def _is_remote(self, node):
+        if not self.network:
+            return False
+        return not node.is_resource() and not node.is_fast() and node.is_cacheable()
+
+    def _transfer(self, node):
+        return predict_download(node, self.bandwidth)
+
+    def _execution(self, node):
+        self._executed.add(node)
+        cost = node.execution_weight
+        if not cost and node.canonical_name in self._measured:
+            total, count = self._measured[node.canonical_name]
+            self._calibrated.add(node)
+            cost = total / count
+        if self._is_remote(node):
+            cost += predict_upload(node, self.bandwidth)
+        return cost
+
+    def _needs_remote_check(self, node):
+        if node.is_alias() or not node.is_cacheable() or node.is_resource():
+            return False
+        if node.available_remotely is not None or not self.cache.download_enabled():
+            return False
+        return not node.is_available_locally(self.cache)
+
+    def _predict_cost(self, node):
+        if node.is_alias():
+            return 0
+        if node.is_cacheable() and not node.is_resource():
+            if node.is_available_locally(self.cache):
+                return 0
+            if self.cache.download_enabled() and node.available_remotely:
+                if self.network and not node.is_goal():
+                    return 0
+                return self._transfer(node)
+        return self._execution(node)
+
+    def _communication(self, node, parent):
+        if self._is_remote(node) or self._is_remote(parent):
+            return self._transfer(node)
+        return 0
+
+    def _update(self, dirty):
+        """ Recomputes the rank of dirty nodes and their requirements """
+        # Nodes are visited in topological order, i.e. after all
+        # the tasks depending on them have been ranked.
+        queued = set(dirty)
+        heap = [self._order[node] for node in queued]
+        heapq.heapify(heap)
+        while heap:
+            node = self._nodes[heapq.heappop(heap)]
+            rank = self._cost[node] + max(
+                [self._communication(node, parent) + self._rank[parent]
+                 for parent in self._parents[node]] + [0])
+            if rank == self._rank.get(node):
+                continue
+            self._rank[node] = rank
+            if node not in self._actual:
+                node.weight = rank
+            for child in self._children[node]:
+                if child not in queued:
+                    queued.add(child)
+                    heapq.heappush(heap, self._order[child])
+
+    def task_finished(self, task):
+        """ Records the outcome of a task and updates the ranks of remaining tasks """
+        if task not in self._cost:
+            return
+        self._actual[task] = task.duration_running.seconds if task.duration_running else 0
+        self._instances[task.canonical_name].pop(task, None)
+        if task not in self._executed or task.execution_weight:
+            return
+
+        total, count = self._measured.get(task.canonical_name, (0, 0))
+        self._measured[task.canonical_name] = (total + self._actual[task], count + 1)
+        if count and total / count == (total + self._actual[task]) / (count + 1):
+            return
+
+        dirty = []
+        for node in self._instances[task.canonical_name]:
+            if node.execution_weight or node not in self._executed:
+                continue
+            cost = self._execution(node)
+            if cost != self._cost[node]:
+                self._cost[node] = cost
+                dirty.append(node)
+        self._update(dirty)
+
+    def _critical_nodes(self):
+        nodes = []
+        candidates = [node for node in self._nodes if not self._parents[node]]
+        while candidates:
+            node = max(candidates, key=lambda n: self._rank[n])
+            nodes.append(node)
+            candidates = [child for child in self._children[node]]
+        return list(reversed(nodes))
+
+    def explain(self):
+        """ Logs a comparison of the predicted and actual schedule """
+        actual = self._duration.seconds
+        log.info("Schedule explanation")
+        log.info("  Predicted makespan: {:.1f}s", self.makespan)
+        log.info("    Critical path:    {:.1f}s", self.critical_path)
+        log.info("    Total work:       {:.1f}s on {} executor(s)", self.work, self.parallelism)
+        log.info("  Actual makespan:    {:.1f}s", actual)
+        if actual >= 1 and self.makespan > 0:
+            log.info("  Prediction error:   {:+.0f}%", (self.makespan - actual) / actual * 100)
+
+        log.info("  Critical path (predicted / actual):")
+        for node in self._critical_nodes():
+            log.info("    {:8.1f}s {:8.1f}s  {}{}",
+                     self._cost[node],
+                     self._actual.get(node, 0),
+                     node.short_qualified_name,
+                     " (calibrated)" if node in self._calibrated else "")
+
+        errors = sorted(
+            [node for node in self._actual],
+            key=lambda n: abs(self._actual[n] - self._cost[n]),
+            reverse=True)
+        errors = [node for node in errors[:5] if abs(self._actual[node] - self._cost[node]) >= 1]
+        if errors:
+            log.info("  Largest mispredictions (predicted / actual):")
+            for node in errors:
+                log.info("    {:8.1f}s {:8.1f}s  {}",
+                         self._cost[node], self._actual[node], node.short_qualified_name)
+
+
 class TaskIdentityExtension(ManifestExtension):
     def export_manifest(self, manifest, task):
         for child in [task] + task.extensions + task.descendants:
@@ -807,6 +807,22 @@ class TaskBase(object):
     cacheable = True
     """ Whether the task produces an artifact or not. """
 
+    cpus = None
+    """
+    Number of CPUs used by the task.
+
+    When set, the task is only started once the requested number of CPU
+    tokens are available, in addition to a free task slot. The total number
+    of tokens is configured with ``jolt.cpus`` and defaults to the number of
+    CPUs on the host. :func:`Tools.thread_count() <jolt.Tools.thread_count>`
+    returns the number of granted CPUs, which is used by the builtin CMake,
+    AutoTools and Ninja build tools.
+
+    If not set, the autoweight plugin estimates the demand from the measured
+    CPU usage of previous executions. The estimate is only used to decide
+    when to start the task and doesn't affect the number of threads.
+    """
+
     expires = Immediately()
     """An expiration strategy, defining when the artifact may be evicted from the cache.
 
@@ -877,12 +893,40 @@ class TaskBase(object):
     influence = []
     """ List of influence provider objects """
 
+    isolation = "thread"
+    """
+    Execution isolation of the task.
+
+    By default, tasks are executed in threads of the Jolt process.
+    Tasks that perform heavy Python work in ``run()`` or ``publish()``
+    may set this attribute to ``"process"`` to instead be executed in a
+    forked child process, allowing them to run in parallel with other
+    tasks without contending for the interpreter lock.
+
+    The child process shares the artifact cache with the parent. Its log
+    output and report errors are transferred back to the parent. Process
+    isolation is only supported on platforms where processes can be forked,
+    and not for tasks with extensions. Other tasks are executed in threads.
+    """
+
     joltdir = "."
     """ Path to the directory of the .jolt file where the task was defined. """
 
     joltproject = None
     """ Name of project this task belongs to. """
 
+    memory = None
+    """
+    Amount of memory used by the task, e.g. ``"4G"``.
+
+    When set, the task is only started once the requested amount of
+    memory tokens are available. The total amount is configured with
+    ``jolt.memory`` and defaults to the physical memory of the host.
+
+    If not set, the autoweight plugin estimates the demand from the measured
+    memory usage of previous executions.
+    """
+
     name = None
     """ Name of the task. Derived from class name if not set. """
 
@@ -1,16 +1,22 @@
+import atexit
 import bz2
+import collections
 import copy
 import getpass
 import gzip
 import lzma
 import subprocess
 import os
+import tempfile
 import platform
+import selectors
 import sys
 import threading
+import time
 if os.name != "nt":
     import termios
 import glob
+import math
 import multiprocessing
 import shutil
 import tarfile
@@ -44,7 +50,323 @@ def stderr_write(line):
     sys.stderr.flush()
 
 
-def _run(cmd, cwd, env, preexec_fn, *args, **kwargs):
+class _ResourceUsage(object):
+    """
+    Peak resource usage of commands run by a Tools object.
+
+    The CPU usage is the highest observed ratio between CPU time and
+    wall clock time of a command. The memory usage is the peak resident
+    set size of any process, multiplied by the CPU usage of its command.
+    """
+
+    def __init__(self):
+        self.cpus = 0
+        self.memory = 0
+        self._lock = threading.Lock()
+
+    def add(self, rusage, wallclock):
+        cputime = rusage.ru_utime + rusage.ru_stime
+        maxrss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        # Short commands give unreliable CPU usage ratios
+        cpus = max(1, int(math.ceil(cputime / wallclock))) if wallclock >= 1 else 1
+        with self._lock:
+            self.cpus = max(self.cpus, cpus)
+            self.memory = max(self.memory, maxrss * cpus)
+
+    def update(self, cpus, memory):
+        """ Merges usage recorded elsewhere, e.g. in a child process. """
+        with self._lock:
+            self.cpus = max(self.cpus, cpus)
+            self.memory = max(self.memory, memory)
+
+
+def _wait(p, usage, started):
+    # Like p.wait(), but also records the resource usage of the process
+    _, status, rusage = os.wait4(p.pid, 0)
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    usage.add(rusage, time.monotonic() - started)
+
+
+class JobServer(object):
+    """
+    GNU make jobserver shared by all commands run by Jolt.
+
+    The jobserver is a pipe or named pipe filled with one token per
+    CPU, minus the token implicitly owned by each client. It is advertised
+    to commands through the MAKEFLAGS environment variable. Make and Ninja
+    children then draw job tokens from the same global pool instead of
+    assuming that they own every CPU on the machine.
+
+    The named pipe mode requires GNU make 4.4 or Ninja 1.13 and later.
+    The pipe mode is supported by older versions of make.
+    """
+
+    def __init__(self, mode, tokens):
+        self.mode = mode
+        self.tokens = tokens
+        self.fds = ()
+        self._fd = None
+        self._path = None
+
+        if mode == "fifo":
+            self._path = fs.path.join(tempfile.mkdtemp(prefix="jolt-"), "jobserver")
+            os.mkfifo(self._path, 0o600)
+            self._fd = os.open(self._path, os.O_RDWR | os.O_NONBLOCK)
+            os.write(self._fd, b"+" * (tokens - 1))
+            self.auth = "fifo:" + self._path
+        else:
+            self.fds = os.pipe()
+            os.write(self.fds[1], b"+" * (tokens - 1))
+            self.auth = "{},{}".format(*self.fds)
+        atexit.register(self.close)
+
+    def close(self):
+        for fd in self.fds + ((self._fd,) if self._fd is not None else ()):
+            with utils.ignore_exception():
+                os.close(fd)
+        if self._path:
+            fs.rmtree(fs.path.dirname(self._path), ignore_errors=True)
+
+    def makeflags(self, makeflags=None):
+        """ Returns MAKEFLAGS advertising the jobserver. """
+        if makeflags and "--jobserver-auth" in makeflags:
+            # Already a client of another jobserver, e.g. Jolt invoked by make
+            return makeflags
+        flags = "-j{} --jobserver-auth={}".format(self.tokens, self.auth)
+        return "{} {}".format(makeflags, flags) if makeflags else flags
+
+
+_jobserver = None
+_jobserver_lock = threading.Lock()
+
+
+def get_jobserver():
+    """
+    Returns the process-wide jobserver, or None if disabled.
+
+    The jobserver is enabled by setting the ``jolt.jobserver`` configuration
+    key to ``fifo`` or ``pipe``. The number of tokens is ``jolt.cpus``,
+    which defaults to the number of CPUs on the host.
+    """
+    global _jobserver
+
+    mode = config.get("jolt", "jobserver", None)
+    if not mode or os.name == "nt":
+        return None
+    raise_error_if(mode not in ["fifo", "pipe"],
+                   "Config: jolt.jobserver must be one of 'fifo' or 'pipe'")
+    with _jobserver_lock:
+        if _jobserver is None:
+            _jobserver = JobServer(mode, config.getint("jolt", "cpus", multiprocessing.cpu_count()))
+        return _jobserver
+
+
+class _CommandOutput(object):
+    """
+    Output of a command.
+
+    Lines from both output streams are spooled in the order they were
+    read, see log.SpooledBuffer. Only the last lines of each stream are
+    kept in memory, for error reporting.
+    """
+
+    STDOUT = "o"
+    STDERR = "e"
+
+    def __init__(self, tail):
+        self._spool = log.SpooledBuffer()
+        self._tails = {
+            self.STDOUT: collections.deque(maxlen=tail),
+            self.STDERR: collections.deque(maxlen=tail),
+        }
+
+    def extend(self, stream, lines):
+        # Each line is tagged with its stream. Upper case tags
+        # mark lines ending with a newline.
+        upper = stream.upper()
+        self._spool.write("".join(
+            upper + line if line.endswith("\n") else stream + line + "\n"
+            for line in lines))
+        self._tails[stream].extend(lines)
+
+    def lines(self, stream=None):
+        """ Returns an iterator over (stream, line) tuples. """
+        for line in self._spool.lines():
+            tag = line[0].lower()
+            if stream is None or tag == stream:
+                yield tag, line[1:] if line[0].isupper() else line[1:-1]
+
+    def tail(self, stream):
+        return list(self._tails[stream])
+
+    def close(self):
+        self._spool.close()
+
+
+class _OutputStream(object):
+    """
+    An output pipe of a command.
+
+    Data read from the pipe is split into lines, which are logged and
+    collected in a _CommandOutput. Log records are attributed to the
+    thread that started the command, regardless of which thread reads
+    the pipe.
+    """
+
+    def __init__(self, fileobj, parent, output, logbuf, tag, rstrip):
+        self.fd = fileobj.fileno()
+        self.done = threading.Event()
+        self._parent = parent
+        self._output = output
+        self._logbuf = logbuf
+        self._tag = tag
+        self._rstrip = rstrip
+        self._partial = bytearray()
+
+    def feed(self, data):
+        """ Dispatches all complete lines in a chunk of data. """
+        self._partial += data
+        index = self._partial.rfind(b"\n")
+        if index < 0:
+            return
+        lines = bytes(self._partial[:index]).split(b"\n")
+        del self._partial[:index + 1]
+        self._emit(lines, b"\n")
+
+    def close(self):
+        """ Dispatches the last unterminated line, if any. """
+        try:
+            if self._partial:
+                self._emit([bytes(self._partial)], b"")
+        finally:
+            self.done.set()
+
+    def read_all(self):
+        """ Reads the pipe until it is closed by the command. """
+        try:
+            for data in iter(lambda: os.read(self.fd, _OutputPump.CHUNK_SIZE), b""):
+                self.feed(data)
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def _emit(self, lines, newline):
+        if self._rstrip:
+            lines = [line.rstrip().decode(errors='ignore') for line in lines]
+        else:
+            lines = [(line + newline).decode(errors='ignore') for line in lines]
+        if self._output:
+            with log.map_thread(threading.current_thread(), self._parent):
+                for line in lines:
+                    try:
+                        self._output(line)
+                    except Exception:
+                        pass
+        self._logbuf.extend(self._tag, lines)
+
+
+class _OutputPump(object):
+    """
+    Reads the output pipes of all commands in a single thread.
+
+    Pipes are multiplexed with the selectors module and read in chunks.
+    All complete lines in a chunk are dispatched together, in order.
+    """
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._selector = selectors.DefaultSelector()
+        self._wakeup = os.pipe()
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._run, name="OutputPump", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """ Closes the selector and wakeup pipe, used in forked children. """
+        with utils.ignore_exception():
+            self._selector.close()
+        for fd in self._wakeup:
+            with utils.ignore_exception():
+                os.close(fd)
+
+    def add(self, stream):
+        """ Starts reading an _OutputStream. """
+        with self._lock:
+            self._pending.append(stream)
+        os.write(self._wakeup[1], b"+")
+
+    def _register(self):
+        os.read(self._wakeup[0], 4096)
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for stream in pending:
+            self._selector.register(stream.fd, selectors.EVENT_READ, stream)
+
+    def _read(self, stream):
+        try:
+            data = os.read(stream.fd, self.CHUNK_SIZE)
+        except OSError:
+            data = b""
+        if not data:
+            self._selector.unregister(stream.fd)
+            try:
+                stream.close()
+            except Exception as e:
+                log.debug("Failed to process command output: {}", e)
+            finally:
+                stream.done.set()
+            return
+        try:
+            stream.feed(data)
+        except Exception as e:
+            log.debug("Failed to process command output: {}", e)
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    self._register()
+                else:
+                    self._read(key.data)
+
+
+_output_pump = None
+_output_pump_lock = threading.Lock()
+
+
+def get_output_pump():
+    """ Returns the process-wide command output pump. """
+    global _output_pump
+
+    with _output_pump_lock:
+        if _output_pump is None:
+            _output_pump = _OutputPump()
+        return _output_pump
+
+
+def _reset_output_pump():
+    # The pump thread doesn't survive fork(). The child creates
+    # a new pump when it first runs a command.
+    global _output_pump, _output_pump_lock
+
+    if _output_pump is not None:
+        _output_pump.close()
+    _output_pump = None
+    _output_pump_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_output_pump)
+
+
+def _run(cmd, cwd, env, preexec_fn, usage, *args, **kwargs):
     output = kwargs.get("output")
     output_on_error = kwargs.get("output_on_error")
     output_rstrip = kwargs.get("output_rstrip", True)
@@ -56,6 +378,12 @@ def _run(cmd, cwd, env, preexec_fn, *args, **kwargs):
 
     log.debug("Running: '{0}' (CWD: {1})", cmd, cwd)
 
+    jobserver = get_jobserver()
+    if jobserver is not None:
+        env = copy.copy(env)
+        env["MAKEFLAGS"] = jobserver.makeflags(env.get("MAKEFLAGS"))
+
+    started = time.monotonic()
     p = subprocess.Popen(
         cmd,
         stdin=subprocess.PIPE,
@@ -65,44 +393,27 @@ def _run(cmd, cwd, env, preexec_fn, *args, **kwargs):
         cwd=cwd,
         env=env,
         preexec_fn=preexec_fn,
+        pass_fds=jobserver.fds if jobserver is not None else (),
     )
 
-    class Reader(threading.Thread):
-        def __init__(self, parent, stream, output=None, logbuf=None):
-            super(Reader, self).__init__()
-            self.output = output
-            self.parent = parent
-            self.stream = stream
-            self.logbuf = logbuf if logbuf is not None else []
-            self.start()
-
-        def run(self):
-            line = ""
-            try:
-                with log.map_thread(self, self.parent):
-                    for line in iter(self.stream.readline, b''):
-                        if output_rstrip:
-                            line = line.rstrip()
-                        line = line.decode(errors='ignore')
-                        if self.output:
-                            self.output(line)
-                        self.logbuf.append((self, line))
-            except Exception as e:
-                if self.output:
-                    self.output("{0}", str(e))
-                    self.output(line)
-                self.logbuf.append((self, line))
-
     stdout_func = log.stdout if not output_stdio else stdout_write
     stderr_func = log.stderr if not output_stdio else stderr_write
 
-    logbuf = []
-    stdout = Reader(
-        threading.current_thread(), p.stdout,
-        output=stdout_func if output else None, logbuf=logbuf)
-    stderr = Reader(
-        threading.current_thread(), p.stderr,
-        output=stderr_func if output else None, logbuf=logbuf)
+    logbuf = _CommandOutput(config.getint("jolt", "logtail", 10000))
+    stdout = _OutputStream(
+        p.stdout, threading.current_thread(), stdout_func if output else None,
+        logbuf, _CommandOutput.STDOUT, output_rstrip)
+    stderr = _OutputStream(
+        p.stderr, threading.current_thread(), stderr_func if output else None,
+        logbuf, _CommandOutput.STDERR, output_rstrip)
+    if os.name == "nt":
+        # Pipes can't be multiplexed on Windows
+        for stream in [stdout, stderr]:
+            threading.Thread(target=stream.read_all, daemon=True).start()
+    else:
+        pump = get_output_pump()
+        pump.add(stdout)
+        pump.add(stderr)
 
     def terminate(pid):
         try:
@@ -124,7 +435,10 @@ def _run(cmd, cwd, env, preexec_fn, *args, **kwargs):
 
     timedout = False
     try:
-        p.wait(timeout=timeout)
+        if timeout is None and usage is not None and hasattr(os, "wait4"):
+            _wait(p, usage, started)
+        else:
+            p.wait(timeout=timeout)
     except subprocess.TimeoutExpired:
         timedout = True
         try:
@@ -134,35 +448,32 @@ def _run(cmd, cwd, env, preexec_fn, *args, **kwargs):
             kill(p.pid)
             p.wait()
     finally:
-        stdout.join()
-        stderr.join()
+        stdout.done.wait()
+        stderr.done.wait()
         p.stdin.close()
         p.stdout.close()
         p.stderr.close()
 
-    if p.returncode != 0 and output_on_error:
-        for reader, line in logbuf:
-            if reader is stdout:
-                log.stdout(line)
-            else:
-                log.stderr(line)
-
-    stdoutbuf = []
-    stderrbuf = []
-    for reader, line in logbuf:
-        if reader is stdout:
-            stdoutbuf.append(line)
-        else:
-            stderrbuf.append(line)
-
-    if p.returncode != 0:
-        stderrbuf = [line for reader, line in logbuf if reader is stderr]
-        raise JoltCommandError(
-            "Command {0}: {1}".format(
-                "timeout" if timedout else "failed",
-                " ".join(cmd) if type(cmd) == list else cmd.format(*args, **kwargs)),
-            stdoutbuf, stderrbuf, p.returncode)
-    return "\n".join(stdoutbuf) if output_rstrip else "".join(stdoutbuf)
+    try:
+        if p.returncode != 0 and output_on_error:
+            for tag, line in logbuf.lines():
+                if tag == _CommandOutput.STDOUT:
+                    log.stdout(line)
+                else:
+                    log.stderr(line)
+
+        if p.returncode != 0:
+            # Only the tail of the output is kept in the exception
+            raise JoltCommandError(
+                "Command {0}: {1}".format(
+                    "timeout" if timedout else "failed",
+                    " ".join(cmd) if type(cmd) == list else cmd.format(*args, **kwargs)),
+                logbuf.tail(_CommandOutput.STDOUT), logbuf.tail(_CommandOutput.STDERR), p.returncode)
+
+        stdoutbuf = [line for _, line in logbuf.lines(_CommandOutput.STDOUT)]
+        return "\n".join(stdoutbuf) if output_rstrip else "".join(stdoutbuf)
+    finally:
+        logbuf.close()
 
 
 class _String(object):
@@ -253,9 +564,13 @@ class _CMake(object):
     def build(self, release=True, *args, **kwargs):
         threading_args = ''
         try:
-            threading_args = ' -j {}'.format(kwargs.get("threads", self.tools.thread_count())) \
-                if "--parallel" in self.tools.run("cmake --help-manual cmake 2>&1", output=False) \
-                   else ''
+            # With a fifo jobserver, the native build tool draws job tokens
+            # from it. Ninja doesn't support pipe jobservers.
+            jobserver = get_jobserver()
+            if "threads" in kwargs or jobserver is None or jobserver.mode != "fifo":
+                threading_args = ' -j {}'.format(kwargs.get("threads", self.tools.thread_count())) \
+                    if "--parallel" in self.tools.run("cmake --help-manual cmake 2>&1", output=False) \
+                    else ''
         except Exception:
             pass
 
@@ -321,8 +636,9 @@ class _AutoTools(object):
 
     def build(self, *args, **kwargs):
         with self.tools.cwd(self.builddir), self.tools.environ(DESTDIR=self.installdir):
-            self.tools.run("make VERBOSE=yes Q= V=1 -j{0}",
-                           self.tools.cpu_count(), output=True)
+            # With a jobserver, make draws job tokens from it
+            threads = " -j{}".format(self.tools.thread_count()) if get_jobserver() is None else ""
+            self.tools.run("make VERBOSE=yes Q= V=1{0}", threads, output=True)
 
     def install(self, target="install", **kwargs):
         with self.tools.cwd(self.builddir), self.tools.environ(DESTDIR=self.installdir):
@@ -455,6 +771,7 @@ class Tools(object):
         self._cwd = fs.path.normpath(fs.path.join(config.get_workdir(), cwd or config.get_workdir()))
         self._env = copy.deepcopy(env or os.environ)
         self._task = task
+        self._usage = _ResourceUsage()
         if task:
             self._env["JOLTDIR"] = task.joltdir
             self._env["JOLTBUILDDIR"] = self.buildroot
@@ -738,9 +1055,17 @@ class Tools(object):
     def thread_count(self):
         """ Number of threads to use for a task.
 
+        If the task declares a CPU demand, the number of CPUs granted
+        to the task by the scheduler is returned. Otherwise, the number
+        of threads is read from the ``jolt.threads`` configuration key
+        or the ``JOLT_THREADS`` environment variable, and defaults to
+        the number of CPUs on the host.
+
         Returns:
             int: number of threads to use.
         """
+        if self._task is not None and self._task.cpus:
+            return int(self._task.cpus)
         threads = config.get("jolt", "threads", self.getenv("JOLT_THREADS", None))
         return int(threads) if threads else self.cpu_count()
 
@@ -1337,7 +1662,7 @@ class Tools(object):
                     cmd = self._run_prefix + cmd
                 else:
                     cmd = " ".join(self._run_prefix) + " " + cmd
-            return _run(cmd, self._cwd, self._env, self._preexec_fn, *args, **kwargs)
+            return _run(cmd, self._cwd, self._env, self._preexec_fn, self._usage, *args, **kwargs)
         finally:
             if stdi:
                 termios.tcsetattr(sys.stdin.fileno(), termios.TCSANOW, stdi)
@@ -0,0 +1,130 @@
+"""
+Build execution tracing.
+
+Records spans of time spent in the different phases of a build and
+exports them in the Chrome trace event format, which can be loaded into
+Perfetto (https://ui.perfetto.dev) or chrome://tracing. Spans are
+attributed to the thread that executed them and, if related to a task,
+annotated with the name and identity of the task.
+
+Tracing is disabled by default and recording is a no-op until
+enable() has been called.
+"""
+
+from contextlib import contextmanager
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+
+
+_enabled = False
+_lock = threading.Lock()
+_events = []
+_threads = set()
+_pids = itertools.count(os.getpid() + 1)
+
+
+def enable():
+    global _enabled
+    with _lock:
+        if _enabled:
+            return
+        _enabled = True
+        _events.append(_metadata("process_name", os.getpid(), 0, "jolt ({})".format(socket.gethostname())))
+
+
+def is_enabled():
+    return _enabled
+
+
+def now():
+    """ Returns a trace timestamp, in microseconds. """
+    return time.time() * 1000000
+
+
+def _metadata(name, pid, tid, value):
+    return {"name": name, "ph": "M", "pid": pid, "tid": tid, "args": {"name": value}}
+
+
+def _task_args(task, args):
+    if task is not None:
+        args["task"] = task.short_qualified_name
+        args["identity"] = task.identity
+    return args
+
+
+def complete(name, start, end=None, category="jolt", task=None, **args):
+    """
+    Records a span between two timestamps returned by now().
+
+    The span is attributed to the calling thread.
+    """
+    if not _enabled:
+        return
+    end = end if end is not None else now()
+    pid = os.getpid()
+    tid = threading.get_ident()
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": start,
+        "dur": max(0, end - start),
+        "pid": pid,
+        "tid": tid,
+        "args": _task_args(task, args),
+    }
+    with _lock:
+        if (pid, tid) not in _threads:
+            _threads.add((pid, tid))
+            _events.append(_metadata("thread_name", pid, tid, threading.current_thread().name))
+        _events.append(event)
+
+
+@contextmanager
+def span(name, category="jolt", task=None, **args):
+    """ Records the time spent in the context as a span. """
+    if not _enabled:
+        yield
+        return
+    start = now()
+    try:
+        yield
+    finally:
+        complete(name, start, category=category, task=task, **args)
+
+
+def merge(events):
+    """
+    Merges events recorded by another process, e.g. a remote worker.
+
+    The events are assigned new process ids to keep them apart from
+    events recorded locally and in other merged processes.
+    """
+    if not _enabled:
+        return
+    pids = {}
+    with _lock:
+        for event in events:
+            event = dict(event)
+            if event["pid"] not in pids:
+                pids[event["pid"]] = next(_pids)
+            event["pid"] = pids[event["pid"]]
+            _events.append(event)
+
+
+def dumps():
+    with _lock:
+        return json.dumps({"traceEvents": _events, "displayTimeUnit": "ms"})
+
+
+def loads(data):
+    return json.loads(data).get("traceEvents", [])
+
+
+def write(path):
+    with open(path, "w") as f:
+        f.write(dumps())
@@ -1,5 +1,7 @@
+import base64
 import contextlib
 import fnmatch
+import math
 import re
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -92,6 +94,17 @@ def as_human_size(size):
     return "{0} {1}".format(round(size, ndigits=unit_precision[index][1]), unit_precision[index][0])
 
 
+def parse_size(size):
+    """ Converts a size such as '512M', '4 G' or 1024 into a number of bytes. """
+    if isinstance(size, int):
+        return size
+    units = {"B": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    size = str(size).strip().upper().rstrip("B") or "0"
+    if size[-1] in units:
+        return int(float(size[:-1].strip()) * units[size[-1]])
+    return int(size)
+
+
 def as_dirpath(dirpath):
     return dirpath + os.path.sep if dirpath[-1] != os.path.sep else dirpath
 
@@ -416,6 +429,43 @@ def filesha1(path):
     return sha.hexdigest()
 
 
+class BloomFilter(object):
+    """
+    Compact set membership summary.
+
+    Membership tests may return false positives, at approximately
+    the configured rate, but never false negatives.
+    """
+
+    def __init__(self, capacity=1, error_rate=0.01, bits=None, hashes=None):
+        capacity = max(1, capacity)
+        self.bits = bits or max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = hashes or max(1, int(round(self.bits / capacity * math.log(2))))
+        self.data = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.sha1(key.encode()).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little")
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.data[pos // 8] |= 1 << (pos % 8)
+
+    def __contains__(self, key):
+        return all(self.data[pos // 8] & (1 << (pos % 8)) for pos in self._positions(key))
+
+    def todict(self):
+        return {"bits": self.bits, "hashes": self.hashes, "data": base64.b64encode(self.data).decode()}
+
+    @staticmethod
+    def fromdict(data):
+        bloom = BloomFilter(bits=data["bits"], hashes=data["hashes"])
+        bloom.data = bytearray(base64.b64decode(data["data"]))
+        return bloom
+
+
 def fromjson(filepath, ignore_errors=False):
     try:
         with open(filepath) as f:
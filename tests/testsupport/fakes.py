@@ -0,0 +1,219 @@
+from concurrent.futures import Future
+from contextlib import contextmanager
+import os
+from types import SimpleNamespace
+
+from requests.exceptions import RequestException
+
+from jolt.error import JoltCommandError
+
+
+class FakeReport(object):
+    def __init__(self):
+        self.exceptions = []
+
+    def add_exception(self, e):
+        self.exceptions.append(e)
+
+
+class FakeTask(object):
+    """ A task, as seen through the task attribute of a task proxy """
+
+    def __init__(self, cpus=None, memory=None, selfsustained=False):
+        self.cpus = cpus
+        self.memory = memory
+        self.selfsustained = selfsustained
+        self.reported = FakeReport()
+        self._instance = SimpleNamespace(value="instance")
+
+    @contextmanager
+    def report(self):
+        yield self.reported
+
+
+class FakeNode(object):
+    """ A task proxy in a task graph """
+
+    def __init__(self, name="node", weight=0, execution_weight=0, transfer_weight=None, upload_weight=None,
+                 artifact_size=0, available_remotely=None, children=None, resource=False,
+                 cpus=None, memory=None, cpus_estimate=None, memory_estimate=None, selfsustained=False):
+        self.canonical_name = name
+        self.qualified_name = name
+        self.short_qualified_name = name
+        self.identity = name + "-0123456789abcdef"
+        self.log_name = "({} {})".format(name, self.identity[:8])
+        self.task = FakeTask(cpus, memory, selfsustained)
+        self.graph = None
+        self.batch = None
+        self.extensions = []
+        self.children = children or []
+        self.resource = resource
+        self.execution_weight = execution_weight
+        self.transfer_weight = transfer_weight
+        self.upload_weight = upload_weight
+        self.artifact_size = artifact_size
+        self.cpus_estimate = cpus_estimate
+        self.memory_estimate = memory_estimate
+        self.available_remotely = available_remotely
+        self.remote_checks = 0
+        self.duration_running = None
+        self.weights = [weight]
+
+    @property
+    def weight(self):
+        return self.weights[-1]
+
+    @weight.setter
+    def weight(self, weight):
+        self.weights.append(weight)
+
+    def is_alias(self):
+        return False
+
+    def is_cacheable(self):
+        return True
+
+    def is_resource(self):
+        return self.resource
+
+    def is_goal(self, with_extensions=True):
+        return False
+
+    def in_progress(self):
+        return False
+
+    def has_artifact(self):
+        return True
+
+    def disable_download(self):
+        pass
+
+    def is_available_locally(self, cache):
+        return False
+
+    def is_available_remotely(self, cache):
+        self.remote_checks += 1
+        self.available_remotely = False
+        return False
+
+    def verbose(self, fmt, *args, **kwargs):
+        pass
+
+
+class FakeGraph(object):
+    """ A task graph, built from (dependent, requirement) edges """
+
+    def __init__(self, *edges):
+        self.parents = {}
+        self.children = {}
+        for parent, child in edges:
+            self.parents.setdefault(child, []).append(parent)
+            self.children.setdefault(parent, []).append(child)
+        nodes = self.parents.keys() | self.children.keys()
+        self.topological_nodes = [n for n in nodes if n not in self.parents]
+        for node in self.topological_nodes:
+            for child in self.children.get(node, []):
+                if all(parent in self.topological_nodes for parent in self.parents[child]):
+                    self.topological_nodes.append(child)
+        for node in nodes:
+            node.graph = self
+
+    def predecessors(self, node):
+        return self.parents.get(node, [])
+
+    def successors(self, node):
+        return self.children.get(node, [])
+
+
+class FakeArtifactCache(object):
+    """
+    An artifact cache.
+
+    Artifacts are missing locally until downloaded. Downloads and
+    uploads succeed if the remote cache is available.
+    """
+
+    def __init__(self, path=None, identities=None, remote=True):
+        self.path = path
+        self.identities = identities or []
+        self.local = False
+        self.remote = remote
+        self.downloads = 0
+
+    def download_enabled(self):
+        return True
+
+    def get_identities(self):
+        return self.identities
+
+    def is_available_locally(self, node):
+        return self.local
+
+    def download(self, node, force=False):
+        self.downloads += 1
+        self.local = self.remote
+        return self.remote
+
+    def upload_async(self, node, executor, lock, force=False):
+        future = Future()
+        future.set_result(self.remote)
+        return future
+
+    @contextmanager
+    def get_artifact(self, node):
+        yield SimpleNamespace(path=self.path)
+
+
+class FakeExecutorRegistry(object):
+    def __init__(self, parameters=None):
+        self.parameters = parameters or {}
+
+    def get_network_parameters(self, task):
+        return self.parameters
+
+
+class FakeTools(object):
+    """ Tools recording the commands run, optionally failing those matching a pattern """
+
+    def __init__(self, basedir, fail=None):
+        self.basedir = basedir
+        self.fail = fail
+        self.commands = []
+        self.removed = []
+
+    def expand_path(self, fmt, *args):
+        return os.path.join(self.basedir, fmt.format(*args))
+
+    def read_file(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def rmtree(self, path, *args, ignore_errors=False):
+        self.removed.append(path.format(*args))
+
+    def run(self, cmd, *args, **kwargs):
+        cmd = cmd.format(*args)
+        self.commands.append(cmd)
+        if self.fail and self.fail in cmd:
+            raise JoltCommandError("Command failed: " + cmd)
+
+
+class FakeResponse(object):
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession(object):
+    """ An HTTP session recording posted JSON documents """
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.attempts = 0
+        self.posts = []
+
+    def post(self, uri, json):
+        self.attempts += 1
+        if self.fail:
+            raise RequestException("unavailable")
+        self.posts.append(json)
+        return FakeResponse()